@@ -18,6 +18,8 @@ import seaborn as sns
 from getdata import *
 from functions import *
 from plots import *
+from cache import results
+from instrument import instrumented, mark, stage_report
 
 # -- SET STYLES -- #
 
@@ -30,11 +32,63 @@ pd.set_option('display.max_columns', 1000)
 # -- IMPORT LOCAL LIBRARIES -- #
 
 
+# ---------- RESULTS FOR ONE LINKAGE SELECTION ---------- #
+
+# Everything in sections 5 to 10 for a (text, survey, window) selection; kept in
+# the shared result cache so going back to a selection is immediate
+
+@instrumented()
+def linkage_results(main_file, linkage_file, linkage_period, linkage_mode='All in window',
+                    linkage_kernel='None'):
+
+    # The text and survey files are linked once at the widest window (on first
+    # use), each window selected in the drop down box is then a quick filter
+    matched = get_linkage(main_file, linkage_file, linkage_period, linkage_mode)
+
+    # Weight each pair by its time distance (or count every pair fully)
+    weights = None
+    if linkage_kernel != 'None':
+        matched['weight'] = kernel_weights(matched['time_diff'], linkage_period, linkage_kernel)
+        weights = 'weight'
+
+    # Prepare long files for plots
+    matched_raw_long = make_long_raw(matched)
+    matched_scaled_long = make_long_scaled(matched)
+
+    # Correlations by subjectivity/polarity/word count, among all and each
+    # group, with bootstrap confidence intervals
+    sweeps = {}
+    for group in ['All'] + user_groups:
+        df = matched if group == 'All' else matched[matched['userGroup'] == group]
+        sweeps[group] = (corr_by_subjectivity(df, emotions_txt, emotions_svy, weights, ci_resamples),
+                         corr_by_polarity(df, emotions_txt, emotions_svy, weights, ci_resamples),
+                         corr_by_words(df, emotions_txt, emotions_svy, weights, ci_resamples))
+
+    return {'matched': matched,
+            'corr_raw': spearman_corr(matched, corr_raw_list, weights),
+            'corr_scaled': spearman_corr(matched, corr_scaled_list, weights),
+            'ci_raw': bootstrap_spearman(matched, emotions_txt, emotions_svy, n_boot=ci_resamples,
+                                         groups=user_groups, weights=weights),
+            'ci_scaled': bootstrap_spearman(matched, emotions_txt_sc, emotions_svy_sc, n_boot=ci_resamples,
+                                            groups=user_groups, weights=weights),
+            'scatter_raw': make_scatter_reg(matched_raw_long),
+            'scatter_raw_user': make_scatter_reg_user(matched_raw_long),
+            'scatter_scaled': make_scatter_reg(matched_scaled_long),
+            'scatter_scaled_user': make_scatter_reg_user(matched_scaled_long),
+            # All the cross-tabs come from one cube of counts, each table is a slice
+            'cube': consistency_cube(matched, emotions_txt_rk_grp, emotions_svy_rk_grp,
+                                     names=emotions_txt, groups=user_groups, weights=weights),
+            'sweeps': sweeps}
+
+
 # ---------- MAIN PAGE ---------- #
 
 
 def main():
 
+    # Stages run from here on are listed in the diagnostics panel
+    run = mark()
+
     # - HEADING - #
     st.markdown("<h1 style='text-align: center; color: black; font-size:60px;'>FRANK APP (ROUND 2)</h1>",
                 unsafe_allow_html=True)
@@ -43,23 +97,25 @@ def main():
 
     # Raw Data
     st.header('1. Import the raw text input data')
+    text_df = load_text()
     st.subheader('1a. Calculate the scaled data and the percentile groupings')
-    st.write(text_df.head(20).astype('object'))
+    paged_table(text_df, 'text', 'inputTime')
     st.subheader('1b. Summarise the raw data')
     st.write(text_df[emotions_txt].describe().round(3).T.astype('object'))
     st.subheader('1c. Summarise the data by daily hours')
-    n_hourly_plots(data=text_by_hr, x="Hour",
+    n_hourly_plots(data=load_text_by_hr(), x="Hour",
                    y="Inputs (n)", title='Number of text inputs by hour')
-    mean_hourly_plots(data=text_hravg_txt, x="Hour",
+    mean_hourly_plots(data=load_text_hravg_txt(), x="Hour",
                       y=emotions_txt, title='Mean emotion by hour (raw values)')
 
     st.write('---')
 
     # Raw Data Rolled up
     st.header('2. Roll up the input text for each user')
+    text_rollup_df = load_rollup()
     st.write('e.g. look at records for userId 19g68kmexxfoh')
     st.subheader('2a. Calculate the scaled data and the percentile groupings')
-    st.write(text_rollup_df.head(20).astype('object'))
+    paged_table(text_rollup_df, 'rollup', 'inputTime')
     st.subheader('2b. Summarise the rolled up data')
     st.write(text_rollup_df[emotions_txt].describe().round(
         3).T.astype('object'))
@@ -69,8 +125,10 @@ def main():
 
     # Daily Moods Data
     st.header('3. Import the raw Daily Moods data')
+    dm_df = load_daily_moods()
+    dm_hourly = load_dm_hourly()
     st.subheader('3a. Calculate the scaled data and the percentile groupings')
-    st.write(dm_df.head(20).astype('object'))
+    paged_table(dm_df, 'dm', 'surveyTime')
     st.subheader('3b. Summarise the Daily Moods data')
     st.write(dm_df[emotions_svy].describe().round(3).T.astype('object'))
     st.subheader('3c. Summarise the data by daily hours')
@@ -83,8 +141,10 @@ def main():
 
     # DEQ Data
     st.header('4. Import the raw DEQ data')
+    deq_df = load_deq()
+    deq_hourly = load_deq_hourly()
     st.subheader('4a. Calculate the scaled data and the percentile groupings')
-    st.write(deq_df.head(20).astype('object'))
+    paged_table(deq_df, 'deq', 'surveyTime')
     st.subheader('4b. Summarise the DEQ data')
     st.write(deq_df[emotions_svy].describe().round(3).T.astype('object'))
     st.subheader('4c. Summarise the data by daily hours')
@@ -95,6 +155,11 @@ def main():
 
     st.write('---')
 
+    # Memory used by the prepared data
+    st.sidebar.subheader('Memory used by the prepared data')
+    st.sidebar.write(memory_report({'Text (raw)': text_df, 'Text (rolled up)': text_rollup_df,
+                                    'Daily Moods': dm_df, 'DEQ': deq_df}))
+
     st.header(
         '5. Link input text data (Algorithm) with survey data (Daily Moods or DEQ)')
 
@@ -107,279 +172,167 @@ def main():
     linkage_file = st.selectbox('', ('Daily Moods', 'DEQ'))
     st.subheader(
         'Step 3. Select a window (minutes) for linking the input Text with surveys input timing')
-    linkage_period = st.selectbox('', (30, 60, 90, 120, 150, 180))
+    linkage_period = st.selectbox('', tuple(linkage_windows))
+    linkage_mode = st.radio('Surveys linked to each text', tuple(linkage_modes))
+    linkage_kernel = st.selectbox('Weight each pair by its time distance',
+                                  ('None',) + tuple(linkage_kernels))
     st.write(
         f'The {main_file} text file is linked with the {linkage_file} survey file within {linkage_period} mins either side of the timing of the survey input')
+    if linkage_mode == 'Nearest survey':
+        st.write('Each text is linked only to the nearest survey in the window')
+    elif linkage_mode == 'Nearest text':
+        st.write('Each survey is linked only to the nearest text in the window')
+    if linkage_kernel != 'None':
+        st.write(f'Pairs are weighted by a {linkage_kernel.lower()} kernel of their time distance: '
+                 'correlations are weighted and the cross-tab counts are sums of the weights')
 
-    # ---- RUN THE DATA LINKAGE ---- #
-
-    # Select the linkage file and time window in the drop down box
+    # ---- RUN THE DATA LINKAGE AND THE ANALYSES (OR REUSE THEM) ---- #
 
-    if main_file == 'Raw':
-        main_txt_file = text_df
-    elif main_file == "Rolled up":
-        main_txt_file = text_rollup_df
+    selection = (main_file, linkage_file, linkage_period, linkage_mode, linkage_kernel, data_version())
+    res = results.get(selection,
+                      lambda: linkage_results(main_file, linkage_file, linkage_period, linkage_mode,
+                                              linkage_kernel))
+    matched = res['matched']
 
-    if linkage_file == 'DEQ':
-        svy_file = deq_df
-    elif linkage_file == "Daily Moods":
-        svy_file = dm_df
-
-    # Run the linkage
-    matched = linkage(main_df=main_txt_file,
-                      linkdf=svy_file,
-                      mins=linkage_period)
+    st.sidebar.subheader('Result cache')
+    st.sidebar.write(results.stats())
 
     # Get the number of matched records
     n_records = matched.shape[0]
 
-    # Prepare long files for plots
-    if linkage_file == "Daily Moods":
-        matched_raw_long = make_long_raw(matched)
-        matched_scaled_long = make_long_scaled(matched)
-    elif linkage_file == "DEQ":
-        matched_raw_long = make_long_raw(matched)
-        matched_scaled_long = make_long_scaled(matched)
-
     # View the matched data
 
     st.subheader(
         f'5a. View the matched data, there are {n_records} matched records')
     st.write('inputTime = The time the text was submitted. surveyTime = The time the survey was submitted.')
-    st.write(matched.astype('object'))
+    paged_table(matched, 'matched', 'inputTime')
 
     # -- Raw -- #
     st.subheader('5b. Correlations (Raw Data)')
-    st.write(spearman_corr(matched, corr_raw_list))
+    st.write(res['corr_raw'])
+    st.write('95% bootstrap confidence intervals (resampling users)')
+    st.write(ci_table(res['ci_raw']))
     # Scatter plot
     st.subheader('5c. Scatter Plot with Regression Line (Raw Data)')
-    ScatterReg(matched_raw_long)
+    show_figure(res['scatter_raw'])
     # Scatter plot BY ueserGroup
     st.subheader(
         '5d. Scatter Plot with Regression Line BY User Group (Raw Data)')
-    ScatterRegUser(matched_raw_long)
+    show_figure(res['scatter_raw_user'])
 
   # -- Scaled -- #
     st.subheader('5e. Correlations (Scaled Data)')
-    st.write(spearman_corr(matched, corr_scaled_list))
+    st.write(res['corr_scaled'])
+    st.write('95% bootstrap confidence intervals (resampling users)')
+    st.write(ci_table(res['ci_scaled']))
     # Scatter plot
     st.subheader('5f. Scatter Plot with Regression Line (Scaled Data)')
-    ScatterReg(matched_scaled_long)
+    show_figure(res['scatter_scaled'])
     # Scatter plot BY ueserGroup
     st.subheader(
         '5g. Scatter Plot with Regression Line BY User Group (Scaled Data)')
-    ScatterRegUser(matched_scaled_long)
+    show_figure(res['scatter_scaled_user'])
 
     st.write('---')
 
     # Comparison of tertile membership
     st.header('6. Membership in Low/Medium/High groups (Algorithm vs. Survey)')
 
-    st.subheader('---- AMONG ALL ----')
-    
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6a. Anger')
-        anger = consistency_counts(
-            matched, 'txt_Anger_rank_grp', 'Anger_rank_grp')
-        st.write(anger.astype('object'))
-    with col2:
-        st.subheader('6b. Sadness')
-        sad = consistency_counts(
-            matched, 'txt_Sadness_rank_grp', 'Sadness_rank_grp')
-        st.write(sad.astype('object'))
-    with col3:
-        st.subheader('6c. Fear')
-        fear = consistency_counts(
-            matched, 'txt_Fear_rank_grp', 'Fear_rank_grp')
-        st.write(fear.astype('object'))
-
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6d. Joy')
-        joy = consistency_counts(
-            matched, 'txt_Joy_rank_grp', 'Joy_rank_grp')
-        st.write(joy.astype('object'))
-    with col2:
-        st.subheader('6e. Disgust')
-        disgust = consistency_counts(
-            matched, 'txt_Disgust_rank_grp', 'Disgust_rank_grp')
-        st.write(disgust.astype('object'))
+    cube = res['cube']
 
-    st.write('---')
-    
-    st.subheader('---- AMONG FRANK+KEYBOARD ----')
-    
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6a. Anger')
-        anger = consistency_counts(
-            matched[matched['userGroup']=="FrankKeyboard"], 'txt_Anger_rank_grp', 'Anger_rank_grp')
-        st.write(anger.astype('object'))
-    with col2:
-        st.subheader('6b. Sadness')
-        sad = consistency_counts(
-            matched[matched['userGroup']=="FrankKeyboard"], 'txt_Sadness_rank_grp', 'Sadness_rank_grp')
-        st.write(sad.astype('object'))
-    with col3:
-        st.subheader('6c. Fear')
-        fear = consistency_counts(
-            matched[matched['userGroup']=="FrankKeyboard"], 'txt_Fear_rank_grp', 'Fear_rank_grp')
-        st.write(fear.astype('object'))
-
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6d. Joy')
-        joy = consistency_counts(
-            matched[matched['userGroup']=="FrankKeyboard"], 'txt_Joy_rank_grp', 'Joy_rank_grp')
-        st.write(joy.astype('object'))
-    with col2:
-        st.subheader('6e. Disgust')
-        disgust = consistency_counts(
-            matched[matched['userGroup']=="FrankKeyboard"], 'txt_Disgust_rank_grp', 'Disgust_rank_grp')
-        st.write(disgust.astype('object'))
+    among = [('ALL', 'All'), ('FRANK+KEYBOARD', 'FrankKeyboard'),
+             ('FRANK', 'Frank'), ('KEYBOARD', 'Keyboard')]
 
-    st.write('---')
-    
-    st.subheader('---- AMONG FRANK ----')
-    
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6a. Anger')
-        anger = consistency_counts(
-            matched[matched['userGroup']=="Frank"], 'txt_Anger_rank_grp', 'Anger_rank_grp')
-        st.write(anger.astype('object'))
-    with col2:
-        st.subheader('6b. Sadness')
-        sad = consistency_counts(
-            matched[matched['userGroup']=="Frank"], 'txt_Sadness_rank_grp', 'Sadness_rank_grp')
-        st.write(sad.astype('object'))
-    with col3:
-        st.subheader('6c. Fear')
-        fear = consistency_counts(
-            matched[matched['userGroup']=="Frank"], 'txt_Fear_rank_grp', 'Fear_rank_grp')
-        st.write(fear.astype('object'))
-
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6d. Joy')
-        joy = consistency_counts(
-            matched[matched['userGroup']=="Frank"], 'txt_Joy_rank_grp', 'Joy_rank_grp')
-        st.write(joy.astype('object'))
-    with col2:
-        st.subheader('6e. Disgust')
-        disgust = consistency_counts(
-            matched[matched['userGroup']=="Frank"], 'txt_Disgust_rank_grp', 'Disgust_rank_grp')
-        st.write(disgust.astype('object'))
+    for heading, group in among:
 
-    st.write('---')
-    
-    st.subheader('---- AMONG KEYBOARD ----')
-    
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6a. Anger')
-        anger = consistency_counts(
-            matched[matched['userGroup']=="Keyboard"], 'txt_Anger_rank_grp', 'Anger_rank_grp')
-        st.write(anger.astype('object'))
-    with col2:
-        st.subheader('6b. Sadness')
-        sad = consistency_counts(
-            matched[matched['userGroup']=="Keyboard"], 'txt_Sadness_rank_grp', 'Sadness_rank_grp')
-        st.write(sad.astype('object'))
-    with col3:
-        st.subheader('6c. Fear')
-        fear = consistency_counts(
-            matched[matched['userGroup']=="Keyboard"], 'txt_Fear_rank_grp', 'Fear_rank_grp')
-        st.write(fear.astype('object'))
-
-    col1, col2, col3 = st.beta_columns(3)
-
-    with col1:
-        st.subheader('6d. Joy')
-        joy = consistency_counts(
-            matched[matched['userGroup']=="Keyboard"], 'txt_Joy_rank_grp', 'Joy_rank_grp')
-        st.write(joy.astype('object'))
-    with col2:
-        st.subheader('6e. Disgust')
-        disgust = consistency_counts(
-            matched[matched['userGroup']=="Keyboard"], 'txt_Disgust_rank_grp', 'Disgust_rank_grp')
-        st.write(disgust.astype('object'))
+        st.subheader(f'---- AMONG {heading} ----')
 
-    st.write('---')
+        for emotions_row in (emotions_txt[:3], emotions_txt[3:]):
+            cols = st.beta_columns(3)
+            for col, emotion in zip(cols, emotions_row):
+                with col:
+                    letter = 'abcde'[emotions_txt.index(emotion)]
+                    st.subheader(f'6{letter}. {emotion}')
+                    st.write(consistency_slice(
+                        cube, emotion, group).astype('object'))
+
+        st.write('---')
 
     st.header(
         '7. Correlations between Algorithm and Survey based on subjectivity/polarity/word count of text')
-    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1')
+    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1. The n columns give the number of matched records behind each correlation, and the CI low / CI high columns its 95% bootstrap confidence interval (resampling users)')
 
     st.subheader(
         '7a. By Subjectivity (columns represent increasing subjectivity 0 - 10)')
-    st.write(corr_by_subjectivity(
-        matched, emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['All'][0].astype('object'))
     st.subheader(
         '7b. By Polarity (columns represent increasing sentiment -1.0 to 1.0)')
-    st.write(corr_by_polarity(matched, emotions_txt,
-             emotions_svy).astype('object'))
+    st.write(res['sweeps']['All'][1].astype('object'))
     st.subheader('7c. By Word Count (columns represent increasing word count)')
-    st.write(corr_by_words(matched, emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['All'][2].astype('object'))
 
     st.write('---')
 
     st.header(
         '8. AMONG FRANK+KEYBOARD GROUP: Correlations between Algorithm and Survey based on subjectivity/polarity/word count of text')
-    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1')
+    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1. The n columns give the number of matched records behind each correlation, and the CI low / CI high columns its 95% bootstrap confidence interval (resampling users)')
 
     st.subheader(
         '8a. By Subjectivity (columns represent increasing subjectivity 0 - 10)')
-    st.write(corr_by_subjectivity(
-        matched[matched['userGroup']=="FrankKeyboard"], emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['FrankKeyboard'][0].astype('object'))
     st.subheader(
         '8b. By Polarity (columns represent increasing sentiment -1.0 to 1.0)')
-    st.write(corr_by_polarity(matched[matched['userGroup']=="FrankKeyboard"], emotions_txt,
-             emotions_svy).astype('object'))
+    st.write(res['sweeps']['FrankKeyboard'][1].astype('object'))
     st.subheader('8c. By Word Count (columns represent increasing word count)')
-    st.write(corr_by_words(matched[matched['userGroup']=="FrankKeyboard"], emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['FrankKeyboard'][2].astype('object'))
     
     st.write('---')
 
     st.header(
         '9. AMONG FRANK GROUP: Correlations between Algorithm and Survey based on subjectivity/polarity/word count of text')
-    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1')
+    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1. The n columns give the number of matched records behind each correlation, and the CI low / CI high columns its 95% bootstrap confidence interval (resampling users)')
 
     st.subheader(
         '9a. By Subjectivity (columns represent increasing subjectivity 0 - 10)')
-    st.write(corr_by_subjectivity(
-        matched[matched['userGroup']=="Frank"], emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['Frank'][0].astype('object'))
     st.subheader(
         '9b. By Polarity (columns represent increasing sentiment -1.0 to 1.0)')
-    st.write(corr_by_polarity(matched[matched['userGroup']=="Frank"], emotions_txt,
-             emotions_svy).astype('object'))
+    st.write(res['sweeps']['Frank'][1].astype('object'))
     st.subheader('9c. By Word Count (columns represent increasing word count)')
-    st.write(corr_by_words(matched[matched['userGroup']=="Frank"], emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['Frank'][2].astype('object'))
     
     st.write('---')
 
     st.header(
         '10. AMONG KEYBOARD GROUP: Correlations between Algorithm and Survey based on subjectivity/polarity/word count of text')
-    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1')
+    st.write('Note: Each column represents >=. For example, Subjectivity column "0.10" refers to filtering the data where subjectivity >=0.1. The n columns give the number of matched records behind each correlation, and the CI low / CI high columns its 95% bootstrap confidence interval (resampling users)')
 
     st.subheader(
         '10a. By Subjectivity (columns represent increasing subjectivity 0 - 10)')
-    st.write(corr_by_subjectivity(
-        matched[matched['userGroup']=="Keyboard"], emotions_txt, emotions_svy).astype('object'))
+    st.write(res['sweeps']['Keyboard'][0].astype('object'))
     st.subheader(
         '10b. By Polarity (columns represent increasing sentiment -1.0 to 1.0)')
-    st.write(corr_by_polarity(matched[matched['userGroup']=="Keyboard"], emotions_txt,
-             emotions_svy).astype('object'))
+    st.write(res['sweeps']['Keyboard'][1].astype('object'))
     st.subheader('10c. By Word Count (columns represent increasing word count)')
-    st.write(corr_by_words(matched[matched['userGroup']=="Keyboard"], emotions_txt, emotions_svy).astype('object'))
-    
+    st.write(res['sweeps']['Keyboard'][2].astype('object'))
+
+    st.write('---')
+
+    st.header(
+        '11. Correlations between Algorithm and Survey by linkage window')
+    st.write(f'Every survey within each window (0 to {sensitivity_windows.max()} mins in steps of '
+             f'{sensitivity_windows[1] - sensitivity_windows[0]}) of the text input, among all users '
+             'and each user group. Hover over a point for the number of matched records')
+    # Depends only on the text and survey files, not on the window selected
+    curve = results.get((main_file, linkage_file, 'window sensitivity', data_version()),
+                        lambda: window_sensitivity(get_linkage_index(main_file, linkage_file),
+                                                   emotions_txt, emotions_svy, groups=user_groups))
+    show_figure(make_window_curve(curve))
+
+    # Time, memory and rows of each stage of this run
+    with st.sidebar.beta_expander('Diagnostics'):
+        st.write(stage_report(run))
+
+
 if __name__ == "__main__":
     main()
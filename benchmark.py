@@ -0,0 +1,221 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Time and memory of each stage   #
+#           of the pipeline                 #
+# ----------------------------------------- #
+
+# Usage:
+#   python benchmark.py run --scale 1 10 100 [--label v2] [--no-sentiment]
+#   python benchmark.py run --data path/to/folder --label pilot
+#   python benchmark.py compare v1 v2
+# Each run appends one JSON line per stage to benchmarks.jsonl (see --results).
+
+
+# ---- IMPORTS ---- #
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from functions import *
+from getdata import (keyboard_csv, mood_csv, deq_csv, pipeline_version, clean_keyboard,
+                     score_text, normalise_text, rollup_rows, prepare_daily_moods, prepare_deq)
+import synthetic
+
+
+results_path = 'benchmarks.jsonl'
+
+
+# ---- THE STAGES ---- #
+
+# Each stage takes the state so far and returns (name of its output, output).
+# The rows in / out recorded are the rows of the first input / the output.
+
+def stage_read_keyboard(state):
+    return 'keyboard', clean_keyboard(pd.read_csv(os.path.join(state['data'], keyboard_csv)))
+
+
+def stage_sentiment(state):
+    df = state['keyboard']
+    df['inputText'] = df['inputText'].str.lower()
+    if state['sentiment']:
+        # A fresh cache, so every distinct text is scored
+        scored = score_text(df[['inputText']].copy(), cache_path=state['cache_path'])
+    else:
+        # Random scores, to time the later stages at scales TextBlob cannot reach
+        rng = np.random.default_rng(0)
+        scored = pd.DataFrame({'word_count': df['inputText'].str.split().str.len(),
+                               'polarity': rng.uniform(-1, 1, len(df)).round(3),
+                               'subjectivity': rng.uniform(0, 1, len(df)).round(3)},
+                              index=df.index)
+    df[['word_count', 'polarity', 'subjectivity']] = scored[['word_count', 'polarity', 'subjectivity']]
+    return 'keyboard', df
+
+
+def stage_normalise_text(state):
+    return 'text_df', compact(normalise_text(state['keyboard']))
+
+
+def stage_rollup(state):
+    return 'text_rollup_df', compact(normalise_text(rollup_rows(state['text_df'])))
+
+
+def stage_daily_moods(state):
+    return 'dm_df', prepare_daily_moods(pd.read_csv(os.path.join(state['data'], mood_csv)))
+
+
+def stage_deq(state):
+    return 'deq_df', prepare_deq(pd.read_csv(os.path.join(state['data'], deq_csv)))
+
+
+def stage_temporal_cube(state):
+    return 'temporal_cube', pd.concat(
+        [temporal_cube(state['text_df'], 'Text', 'inputTime', emotions_txt + emotions_txt_sc),
+         temporal_cube(state['dm_df'], 'Daily Moods', 'surveyTime', emotions_svy + emotions_svy_sc),
+         temporal_cube(state['deq_df'], 'DEQ', 'surveyTime', emotions_svy + emotions_svy_sc)])
+
+
+def stage_linkage_index(state):
+    return 'index', linkage_index(state['text_df'], state['dm_df'], linkage_index_mins)
+
+
+def stage_linkage_window(state):
+    return 'matched', linkage_window(state['index'], 90)
+
+
+def stage_consistency_cube(state):
+    return 'cube', consistency_cube(state['matched'], emotions_txt_rk_grp, emotions_svy_rk_grp,
+                                    names=emotions_txt, groups=user_groups)
+
+
+def stage_corr_sweeps(state):
+    matched = state['matched']
+    return 'sweeps', pd.concat([corr_sweep(matched, 'subjectivity', subjectivity_thresholds,
+                                           emotions_txt, emotions_svy),
+                                corr_sweep(matched, 'polarity', polarity_thresholds,
+                                           emotions_txt, emotions_svy),
+                                corr_sweep(matched, 'word_count', word_thresholds,
+                                           emotions_txt, emotions_svy)])
+
+
+stages = [('read_keyboard', 'data', stage_read_keyboard),
+          ('sentiment', 'keyboard', stage_sentiment),
+          ('normalise_text', 'keyboard', stage_normalise_text),
+          ('rollup', 'text_df', stage_rollup),
+          ('daily_moods', 'data', stage_daily_moods),
+          ('deq', 'data', stage_deq),
+          ('temporal_cube', 'text_df', stage_temporal_cube),
+          ('linkage_index', 'text_df', stage_linkage_index),
+          ('linkage_window', 'index', stage_linkage_window),
+          ('consistency_cube', 'matched', stage_consistency_cube),
+          ('corr_sweeps', 'matched', stage_corr_sweeps)]
+
+
+# ---- RUN AND RECORD ---- #
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(data_dir, dataset, label, sentiment=True, memory=True):
+
+    # Runs every stage once on the dataset; time is wall time (perf_counter) and
+    # memory the peak traced by tracemalloc while the stage ran (numpy and
+    # pandas report their buffers to it). Tracing slows pure Python stages a
+    # little, so compare runs made with the same setting.
+    records, revision = [], git_revision()
+    with tempfile.TemporaryDirectory() as tmp:
+        state = {'data': data_dir, 'sentiment': sentiment,
+                 'cache_path': os.path.join(tmp, 'sentiment.sqlite')}
+        for name, input_name, stage in stages:
+            before = state[input_name]
+            if memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            output_name, output = stage(state)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if memory else None
+            if memory:
+                tracemalloc.stop()
+            state[output_name] = output
+
+            records.append({'label': label, 'dataset': dataset, 'stage': name,
+                            'seconds': round(seconds, 4),
+                            'peak_mb': None if peak is None else round(peak / 2**20, 2),
+                            'rows_in': len(before) if isinstance(before, pd.DataFrame) else None,
+                            'rows_out': len(output),
+                            'sentiment': sentiment, 'pipeline_version': pipeline_version,
+                            'git': revision,
+                            'when': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            print(f"{dataset:>10} {name:<18} {seconds:9.3f} s "
+                  f"{'' if peak is None else f'{peak / 2**20:9.1f} MB'}", flush=True)
+    return records
+
+
+def save(records, path=results_path):
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def compare(base, new, path=results_path):
+
+    # Seconds and peak MB of each stage for two labels (latest run of each)
+    df = pd.read_json(path, lines=True)
+    df = df[df['label'].isin([base, new])].drop_duplicates(['label', 'dataset', 'stage'], keep='last')
+    table = df.pivot_table(index=['dataset', 'stage'], columns='label',
+                           values=['seconds', 'peak_mb'], sort=False)
+    table[('seconds', 'ratio')] = (table[('seconds', new)] / table[('seconds', base)]).round(2)
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='time each stage on synthetic or given data')
+    run.add_argument('--scale', type=float, nargs='*', default=[1, 10],
+                     help='synthetic data at these multiples of the pilot users')
+    run.add_argument('--data', help='folder holding the three CSV files (instead of --scale)')
+    run.add_argument('--label', default=git_revision() or 'latest')
+    run.add_argument('--no-sentiment', action='store_true',
+                     help='random sentiment scores instead of TextBlob')
+    run.add_argument('--no-memory', action='store_true', help='time only (no tracemalloc)')
+    run.add_argument('--synthetic', default='synthetic', help='folder for the synthetic data')
+    run.add_argument('--results', default=results_path)
+
+    cmp = sub.add_parser('compare', help='compare two labelled runs')
+    cmp.add_argument('base')
+    cmp.add_argument('new')
+    cmp.add_argument('--results', default=results_path)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if args.data:
+            datasets = [(os.path.basename(os.path.normpath(args.data)), args.data)]
+        else:
+            datasets = []
+            for scale in args.scale:
+                data_dir = os.path.join(args.synthetic, f'x{scale:g}')
+                if not os.path.exists(os.path.join(data_dir, keyboard_csv)):
+                    synthetic.generate(data_dir, scale)
+                datasets.append((f'x{scale:g}', data_dir))
+        for dataset, data_dir in datasets:
+            save(run_benchmark(data_dir, dataset, args.label, not args.no_sentiment,
+                               not args.no_memory), args.results)
+    else:
+        pd.set_option('display.width', 200)
+        print(compare(args.base, args.new, args.results))
@@ -0,0 +1,90 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: In-memory cache of the results  #
+#           for each linkage selection      #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# ---- SIZE OF A CACHED RESULT ---- #
+
+def result_size(value):
+
+    # Bytes held by a result: frames and arrays exactly, figures by their JSON
+    # spec, containers by their contents
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(result_size(k) + result_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(result_size(v) for v in value)
+    if hasattr(value, 'to_json'):
+        return len(value.to_json())
+    return sys.getsizeof(value)
+
+
+# ---- LEAST RECENTLY USED CACHE, BOUNDED BY MEMORY ---- #
+
+class ResultCache:
+
+    def __init__(self, max_mb=256):
+        self.max_bytes = max_mb * 2**20
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self.size = 0
+
+    def get(self, key, compute):
+
+        # The result for this key, computed (and kept) on a miss
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = compute()
+        nbytes = result_size(value)
+
+        with self.lock:
+            if key not in self.entries and nbytes <= self.max_bytes:
+                self.entries[key] = (value, nbytes)
+                self.size += nbytes
+                # Drop the least recently used results until it fits again
+                while self.size > self.max_bytes:
+                    _, (_, dropped) = self.entries.popitem(last=False)
+                    self.size -= dropped
+                    self.evictions += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return pd.DataFrame({'Value': [len(self.entries), round(self.size / 2**20, 2),
+                                       round(self.max_bytes / 2**20, 2),
+                                       self.hits, self.misses, self.evictions]},
+                            index=['Results', 'MB', 'Limit (MB)', 'Hits', 'Misses', 'Evictions'],
+                            dtype='object')
+
+
+# Shared by every session of the app (the module is imported once per server)
+results = ResultCache(int(os.environ.get('FRANK_RESULT_CACHE_MB', 256)))
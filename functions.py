@@ -10,9 +10,13 @@
 
 # ---- IMPORTS ---- #
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-from textblob import TextBlob
+
+from instrument import instrumented
 
 # from getdata import *
 # from plots import *
@@ -24,6 +28,7 @@ from textblob import TextBlob
 # Userid, inputTime, userGroup
 user_time_grp = ['userId', 'userGroup', 'inputTime']
 user_time = ['userId', 'surveyTime']
+user_info = ['userGroup', 'userLoginTime']
 
 words = ['word_count', 'polarity', 'subjectivity']
 
@@ -54,37 +59,344 @@ emotions_svy_rk_grp = ['Anger_rank_grp', 'Sadness_rank_grp',
 svy_cols = user_time + emotions_svy + emotions_svy_sc + \
     emotions_svy_rk + emotions_svy_rk_grp
 
+# The other DEQ subscales (not scored by the text algorithm)
+deq_other = ['Anxiety_Survey', 'Desire_Survey', 'Relaxation_Survey']
+
+# Columns kept as categoricals / float32 scores in the prepared frames
+category_cols = ['userId', 'username', 'userGroup', 'userLoginTime']
+score_cols = emotions_txt + emotions_txt_sc + emotions_txt_rk + \
+    emotions_svy_sc + emotions_svy_rk
+
+# Dimensions of the temporal aggregate cube
+cube_dims = ['Source', 'userGroup', 'Hour', 'Weekday', 'StudyDay']
+
+# How each column is rolled up across the inputs of a record (see rollup_functions)
+rollup_aggregations = {**{col: 'max' for col in emotions_txt + ['polarity', 'subjectivity']},
+                       'inputText': 'join', 'word_count': 'sum'}
+
 # Scaled variables (algorithm vs. survey)
 corr_raw_list = emotions_txt + emotions_svy
 corr_scaled_list = emotions_txt_sc + emotions_svy_sc
 
+# User groups in the study
+user_groups = ['FrankKeyboard', 'Frank', 'Keyboard']
+
+# Windows (minutes either side of the survey) offered for the linkage
+linkage_windows = [30, 60, 90, 120, 150, 180]
+
+# Windows (mins) of the window sensitivity curve; the linkage index is built
+# wide enough for both
+sensitivity_windows = np.arange(0, 365, 5)
+linkage_index_mins = max(max(linkage_windows), int(sensitivity_windows.max()))
+
+# Every survey in the window, or one match per text / per survey
+linkage_modes = ['All in window', 'Nearest survey', 'Nearest text']
+
+# Kernels weighting each linked pair by its time distance u = |time_diff| / window
+# (the Gaussian and exponential fall to about 0.14 at the edge of the window)
+linkage_kernels = {'Gaussian': lambda u: np.exp(-2 * u ** 2),
+                   'Triangular': lambda u: np.clip(1 - u, 0, None),
+                   'Exponential': lambda u: np.exp(-2 * u)}
+
+# Thresholds (>=) for the correlations by subjectivity / polarity / word count
+subjectivity_thresholds = np.arange(0.1, 1.0, 0.1).round(3)
+polarity_thresholds = np.arange(-1, 1.2, 0.2).round(3)
+word_thresholds = np.arange(0, 50, 5)
+
+# Bootstrap resamples (of users) behind the confidence intervals in the app
+ci_resamples = 200
+
 
 # ---- SENTIMENT ANALYSES ---- #
+
+# TextBlob (and nltk) are slow to import, so they are only imported when
+# something is actually scored
+
 def detect_polarity(text):
+    from textblob import TextBlob
     return TextBlob(text).sentiment.polarity
 
 
 def detect_subjectivity(text):
+    from textblob import TextBlob
     return TextBlob(text).sentiment.subjectivity
 
 
-# ---- CUT THE EMOTION SCORES INTO TERTILES (LOW, MEDIUM, HIGH) ---- #
+def detect_sentiment(text):
+    # Polarity and subjectivity from one parse of the text
+    from textblob import TextBlob
+    sentiment = TextBlob(text).sentiment
+    return sentiment.polarity, sentiment.subjectivity
+
+
+def _score_chunk(texts):
+    return [detect_sentiment(text) for text in texts]
+
+
+@instrumented()
+def score_sentiment(texts, workers=None, chunksize=1000):
 
-def bins3(df, col):
-    tertiles = df[col].describe(percentiles=[0.33, 0.66])
-    return pd.cut(df[col], bins=[0, tertiles[4], tertiles[6], 1.0], duplicates='raise', labels=['1. Low', '2. Medium', '3. High'])
+    # Score every text once, spread over a pool of processes in chunks.
+    # workers=None uses one process per CPU, workers=1 scores in this process.
+    if workers is None:
+        workers = os.cpu_count() or 1
 
+    values = list(texts)
+    chunks = [values[i:i + chunksize]
+              for i in range(0, len(values), chunksize)]
 
-def bins3_dm(df, col):
-    tertiles = df[col].describe(percentiles=[0.33, 0.66])
-    if col == 'Disgust_rank':
-        return pd.cut(df[col], bins=[0, tertiles[4], tertiles[6], 1.0], duplicates='drop', labels=['1. Low/2. Medium', '3. High'])
+    if workers <= 1 or len(chunks) <= 1:
+        scored = map(_score_chunk, chunks)
     else:
-        return pd.cut(df[col], bins=[0, tertiles[4], tertiles[6], 1.0], labels=['1. Low', '2. Medium', '3. High'])
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            scored = list(pool.map(_score_chunk, chunks))
+
+    rows = [row for chunk in scored for row in chunk]
+    return pd.DataFrame(rows, columns=['polarity', 'subjectivity'],
+                        index=getattr(texts, 'index', None), dtype='float64')
+
+
+# ---- ROLL UP RECORDS IN ONE PASS OVER THE ROWS SORTED BY THEIR KEYS ---- #
+
+# Each aggregation gets a column's values sorted by the keys and the start and
+# stop row of every group; missing values are skipped as in a pandas groupby
+
+def _rollup_sum(values, starts, stops):
+    if values.dtype.kind in 'biu':
+        return np.add.reduceat(values.astype('int64'), starts)
+    return np.add.reduceat(np.nan_to_num(values.astype('float64')), starts)
+
+
+def _rollup_mean(values, starts, stops):
+    seen = np.add.reduceat(~np.isnan(values.astype('float64')), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _rollup_sum(values, starts, stops) / seen
+
+
+def _rollup_first(values, starts, stops, last=False):
+    # The first (or last) non-missing value of each group, missing if it has none
+    present = pd.notna(values)
+    at = np.arange(len(values))
+    if last:
+        found = np.maximum.reduceat(np.where(present, at, -1), starts)
+        none = found < starts
+    else:
+        found = np.minimum.reduceat(np.where(present, at, len(values)), starts)
+        none = found >= stops
+    out = values[np.where(none, starts, found)]
+    return pd.Series(out).where(~none).to_numpy() if none.any() else out
+
+
+def _rollup_join(values, starts, stops):
+    present = pd.notna(values)
+    return np.array(['; '.join(values[a:b][present[a:b]]) if present[a:b].any() else None
+                     for a, b in zip(starts, stops)], dtype=object)
+
+
+rollup_functions = {
+    'max': lambda values, starts, stops: np.fmax.reduceat(values, starts),
+    'min': lambda values, starts, stops: np.fmin.reduceat(values, starts),
+    'sum': _rollup_sum,
+    'mean': _rollup_mean,
+    'first': _rollup_first,
+    'last': lambda values, starts, stops: _rollup_first(values, starts, stops, last=True),
+    'join': _rollup_join,
+}
+
+
+@instrumented()
+def rollup(df, keys, aggregations=None):
+
+    # The aggregations are names in rollup_functions or functions of
+    # (values, starts, stops); rollup_aggregations is the default
+    aggregations = aggregations or rollup_aggregations
+
+    # Sort the rows by the keys (stable, so the inputs of a record stay in file
+    # order) and find where each group starts; rows with a missing key are dropped
+    codes = [pd.factorize(df[key], sort=True)[0] for key in keys]
+    ok = np.logical_and.reduce([code >= 0 for code in codes])
+    order = np.flatnonzero(ok)[np.lexsort([code[ok] for code in reversed(codes)])]
+    if len(order) == 0:
+        return pd.DataFrame(columns=keys + list(aggregations))
+    sorted_codes = np.column_stack([code[order] for code in codes])
+    starts = np.flatnonzero(np.r_[True, (sorted_codes[1:] != sorted_codes[:-1]).any(axis=1)])
+    stops = np.r_[starts[1:], len(order)]
+
+    out = df[keys].iloc[order[starts]].reset_index(drop=True)
+    for col, how in aggregations.items():
+        reduce_group = rollup_functions.get(how, how)
+        out[col] = reduce_group(df[col].to_numpy()[order], starts, stops)
+    return out
+
+
+# Partial roll ups (of chunks of the rows, in file order) rolled up again give
+# the full roll up for these aggregations; a mean is carried as a sum and a
+# count of its values. Other aggregations (e.g. functions) cannot be combined.
+combinable_rollups = ['max', 'min', 'sum', 'first', 'last', 'join']
+
+
+def _partial_aggregations(aggregations):
+    cannot = [col for col, how in aggregations.items() if how not in combinable_rollups + ['mean']]
+    if cannot:
+        raise ValueError(f"Partial roll ups of {cannot} cannot be combined "
+                         f"(only {', '.join(combinable_rollups)} and mean)")
+    partial = {}
+    for col, how in aggregations.items():
+        if how == 'mean':
+            partial[col + ' (sum)'] = partial[col + ' (n)'] = 'sum'
+        else:
+            partial[col] = how
+    return partial
+
+
+def partial_rollup(df, keys, aggregations=None):
+    # Roll up of some of the rows, to be combined by combine_rollups
+    aggregations = aggregations or rollup_aggregations
+    means = [col for col, how in aggregations.items() if how == 'mean']
+    if means:
+        df = df.assign(**{col + ' (sum)': df[col] for col in means},
+                       **{col + ' (n)': df[col].notna().astype('int64') for col in means})
+    return rollup(df, keys, _partial_aggregations(aggregations))
+
+
+def combine_rollups(parts, keys, aggregations=None):
+    aggregations = aggregations or rollup_aggregations
+    out = rollup(pd.concat(parts), keys, _partial_aggregations(aggregations))
+    for col, how in aggregations.items():
+        if how == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[col] = out.pop(col + ' (sum)') / out.pop(col + ' (n)')
+    return out[keys + list(aggregations)]
+
+
+# ---- COMPACT STORAGE OF THE PREPARED FRAMES ---- #
+
+def compact(df):
+
+    # Categoricals for the ids and groups, float32 for the emotion scores and
+    # the smallest integer type for the word counts and survey sums (float32
+    # where some are missing). Polarity and subjectivity stay float64 as the
+    # correlation sweeps filter on exact thresholds of them.
+    dtypes = {}
+    for col in df.columns:
+        if col in category_cols:
+            dtypes[col] = 'category'
+        elif col in score_cols:
+            dtypes[col] = 'float32'
+        elif col in emotions_svy + deq_other + ['word_count']:
+            if df[col].isna().any():
+                dtypes[col] = 'float32'
+            else:
+                dtypes[col] = pd.to_numeric(df[col], downcast='integer').dtype
+    return df.astype(dtypes)
+
+
+def memory_report(frames):
+    report = pd.DataFrame({name: {'Rows': df.shape[0],
+                                  'Columns': df.shape[1],
+                                  'MB': df.memory_usage(deep=True).sum() / 2**20}
+                           for name, df in frames.items()}).T
+    return report.astype({'Rows': 'int64', 'Columns': 'int64'}).round({'MB': 2})
+
+
+# ---- TEMPORAL AGGREGATE CUBE (SOURCE x USERGROUP x HOUR x WEEKDAY x STUDY DAY) ---- #
+
+@instrumented()
+def temporal_cube(df, source, time_col, value_cols, group_col='userGroup',
+                  login_col='userLoginTime', by=()):
+
+    # Counts, and sums / non-missing counts of every value column, so that a mean
+    # over any combination of the dimensions is just sum / count of the cells.
+    # StudyDay is the day of the study for the user (1 = the day they logged in);
+    # `by` adds further dimensions (e.g. to combine cubes of chunks of the rows)
+    times = df[time_col]
+    login = pd.to_datetime(df[login_col].astype('object'), format='%Y-%m-%d-%H-%M-%S')
+    values = df[value_cols].astype('float64')
+
+    cells = pd.DataFrame({'Inputs (n)': np.ones(len(df), dtype='int64')}, index=df.index)
+    for col in value_cols:
+        cells[col + '_sum'] = values[col].fillna(0)
+        cells[col + '_n'] = values[col].notna().astype('int64')
+
+    keys = [df[group_col].astype('object').rename('userGroup'),
+            times.dt.hour.rename('Hour'),
+            times.dt.weekday.rename('Weekday'),
+            ((times.dt.normalize() - login.dt.normalize()).dt.days + 1).rename('StudyDay')]
+    keys += [df[col] for col in by]
+    cube = cells.groupby(keys).sum().reset_index()
+    cube.insert(0, 'Source', source)
+    return cube
+
+
+def cube_slice(cube, source, by=('Hour',), values=(), groups=None, weekdays=None):
+
+    # Inputs (n) and the mean of each value column by the chosen dimensions, for
+    # one source and optionally some user groups / weekdays (0 = Monday)
+    res = cube[cube['Source'] == source]
+    if groups is not None:
+        res = res[res['userGroup'].isin(groups)]
+    if weekdays is not None:
+        res = res[res['Weekday'].isin(weekdays)]
+
+    cells = [col for col in res.columns if col not in cube_dims]
+    summed = res.groupby(list(by))[cells].sum()
+    out = summed[['Inputs (n)']].copy()
+    for col in values:
+        out[col] = summed[col + '_sum'] / summed[col + '_n'].replace(0, np.nan)
+    return out.reset_index()
+
 
 # ---- DATA LINKAGE BETWEEN INPUT TEXT AND EITHER DAILY MOODS OR DEQ ---- #
 
 
+def _interval_pairs(text_ids, text_times, svy_ids, svy_lo, svy_hi):
+
+    # Put every (userId, time) key on one dense integer scale so the users and
+    # the times can be searched together with a single sorted array
+    ids = pd.factorize(np.concatenate([np.asarray(text_ids, dtype=object),
+                                       np.asarray(svy_ids, dtype=object)]))[0] + 1
+    text_code, svy_code = ids[:len(text_ids)], ids[len(text_ids):]
+
+    times = np.concatenate([text_times, svy_lo, svy_hi]).astype('int64')
+    ranks = np.unique(times, return_inverse=True)[1].reshape(-1) + 1
+    n_t, n_s = len(text_times), len(svy_lo)
+    width = ranks.max(initial=0) + 1
+    text_key = text_code * width + ranks[:n_t]
+    lo_key = svy_code * width + ranks[n_t:n_t + n_s]
+    hi_key = svy_code * width + ranks[n_t + n_s:]
+
+    # Missing times never match (NaT comparisons are always False)
+    text_ok = ~pd.isnull(text_times)
+    svy_ok = ~(pd.isnull(svy_lo) | pd.isnull(svy_hi))
+
+    # Sort the surveys by (userId, time); the window has the same width for every
+    # survey so 'before' and 'after' are both sorted in this order
+    svy_pos = np.flatnonzero(svy_ok)
+    svy_pos = svy_pos[np.argsort(lo_key[svy_pos], kind='mergesort')]
+
+    # For each text: surveys with after >= inputTime and before <= inputTime
+    start = np.searchsorted(hi_key[svy_pos], text_key, side='left')
+    stop = np.searchsorted(lo_key[svy_pos], text_key, side='right')
+    counts = np.where(text_ok, np.clip(stop - start, 0, None), 0)
+
+    # Expand the matches (cost grows with the number of matched pairs only)
+    text_idx = np.repeat(np.arange(n_t), counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    svy_idx = svy_pos[np.repeat(start, counts) + np.arange(counts.sum()) - offsets]
+
+    # Same row order as the old merge: by text row, then by survey row
+    order = np.lexsort((svy_idx, text_idx))
+    text_idx, svy_idx = text_idx[order], svy_idx[order]
+
+    # Row labels of the old merge were the positions in the userId cross product
+    svy_per_user = np.bincount(svy_code, minlength=ids.max(initial=0) + 1)
+    cross = svy_per_user[text_code]
+    svy_rank = pd.Series(svy_code).groupby(svy_code).cumcount().values
+    labels = (np.cumsum(cross) - cross)[text_idx] + svy_rank[svy_idx]
+
+    return text_idx, svy_idx, labels
+
+
 def linkage(main_df, linkdf, mins):
 
     # Calculate a time period for matching
@@ -93,23 +405,148 @@ def linkage(main_df, linkdf, mins):
 
     ba = ['before', 'after']
 
-    # Matching Step 1: Merge on the userId
-    merge1 = pd.merge(main_df[text_cols],
-                      linkdf[svy_cols + ba],
-                      how='inner',
-                      left_on='userId',
-                      right_on='userId')
-    # Matching Step 2: Filter out only records where the text input time is between the selected survey times
-    merge2 = merge1[(merge1['inputTime'] >= merge1['before'])
-                    & (merge1['inputTime'] <= merge1['after'])]
+    # Matching: sort the surveys by (userId, time) and binary search the window
+    # for every text input, rather than merging every text with every survey
+    text_idx, svy_idx, labels = _interval_pairs(main_df['userId'].values,
+                                                main_df['inputTime'].values,
+                                                linkdf['userId'].values,
+                                                linkdf['before'].values,
+                                                linkdf['after'].values)
+
+    left = main_df[text_cols].take(text_idx)
+    right = linkdf[svy_cols + ba].drop(columns='userId').take(svy_idx)
+    left.index = right.index = labels
+
+    return pd.concat([left, right], axis=1)
+
+
+# ---- LINKAGE INDEX: LINK ONCE AT THE WIDEST WINDOW, THEN FILTER ---- #
+
+@instrumented()
+def linkage_index(main_df, linkdf, max_mins):
+
+    # Every candidate pair within the widest window, with the signed time
+    # difference (inputTime - surveyTime) in minutes
+    index = linkage(main_df, linkdf[svy_cols].copy(), max_mins)
+    index['time_diff'] = (index['inputTime'] -
+                          index['surveyTime']) / pd.Timedelta(minutes=1)
+    index.attrs['max_mins'] = max_mins
+
+    return index
+
+
+@instrumented()
+def linkage_window(index, mins):
+
+    if mins > index.attrs.get('max_mins', mins):
+        raise ValueError(
+            f"Window of {mins} mins is wider than the linkage index ({index.attrs['max_mins']} mins)")
+
+    # A smaller window is just a filter on the time difference
+    matched = index[index['time_diff'].abs() <= mins].copy()
+    matched['before'] = matched['surveyTime'] - pd.Timedelta(minutes=mins)
+    matched['after'] = matched['surveyTime'] + pd.Timedelta(minutes=mins)
+
+    return matched
+
+
+@instrumented()
+def linkage_nearest(main_df, linkdf, mins, mode='Nearest survey'):
+
+    # Only the nearest survey for each text ('Nearest survey') or the nearest
+    # text for each survey ('Nearest text') within the window, so no input is
+    # counted twice. A sorted as-of join on time by userId: one binary search
+    # per row, however many surveys sit in the window
+    n_t = len(main_df)
+    users = pd.factorize(np.concatenate([main_df['userId'].astype(object).values,
+                                         linkdf['userId'].astype(object).values]))[0]
+    text = pd.DataFrame({'user': users[:n_t], 'time': main_df['inputTime'].values,
+                         'text_row': np.arange(n_t)})
+    svy = pd.DataFrame({'user': users[n_t:], 'time': linkdf['surveyTime'].values,
+                        'svy_row': np.arange(len(linkdf))})
+    text, svy = [df[(df['user'] >= 0) & df['time'].notna()].sort_values('time', kind='mergesort')
+                 for df in (text, svy)]
+
+    left, right = (text, svy) if mode == 'Nearest survey' else (svy, text)
+    pairs = pd.merge_asof(left, right, on='time', by='user', direction='nearest',
+                          tolerance=pd.Timedelta(minutes=mins)).dropna(subset=['text_row', 'svy_row'])
+    pairs = pairs.astype({'text_row': 'int64', 'svy_row': 'int64'}).sort_values(['text_row', 'svy_row'])
+
+    # Same columns as the window linkage, plus the time difference
+    ba = ['before', 'after']
+    linkdf = linkdf[svy_cols].copy()
+    linkdf['before'] = linkdf['surveyTime'] - pd.Timedelta(minutes=mins)
+    linkdf['after'] = linkdf['surveyTime'] + pd.Timedelta(minutes=mins)
+    left = main_df[text_cols].take(pairs['text_row'].values)
+    right = linkdf[svy_cols + ba].drop(columns='userId').take(pairs['svy_row'].values)
+    left.index = right.index = range(len(pairs))
+    matched = pd.concat([left, right], axis=1)
+    matched['time_diff'] = (matched['inputTime'] -
+                            matched['surveyTime']) / pd.Timedelta(minutes=1)
+
+    return matched
+
+
+@instrumented()
+def window_sensitivity(index, textlist, svylist, windows=sensitivity_windows, group_col='userGroup',
+                       groups=(), max_cells=4000000):
+
+    # Spearman correlation (and n) of each Algorithm/Survey pair for every
+    # window, among all pairs and within each group, without linking again.
+    # With the pairs ordered by time distance each window is a prefix of that
+    # order; the prefixes are rows of 0/1 weights, all ranked in one batch
+    windows = np.asarray(windows)
+    if windows.max(initial=0) > index.attrs.get('max_mins', np.inf):
+        raise ValueError(
+            f"Window of {windows.max()} mins is wider than the linkage index ({index.attrs['max_mins']} mins)")
+
+    distance = index['time_diff'].abs().to_numpy(dtype='float64')
+    order = np.argsort(distance, kind='mergesort')
+    position = np.empty(len(order), dtype='int64')
+    position[order] = np.arange(len(order))
+    prefix = np.searchsorted(distance[order], windows, side='right')
+
+    subsets = [('All', np.ones(len(index), dtype=bool))] + \
+        [(group, (index[group_col] == group).to_numpy()) for group in groups]
+    step = max(1, max_cells // max(len(index), 1))
+
+    results = []
+    for t, s in zip(textlist, svylist):
+        x = index[t].to_numpy(dtype='float64')
+        y = index[s].to_numpy(dtype='float64')
+        x_blocks, y_blocks = _tie_blocks(x), _tie_blocks(y)
+        for name, rows in subsets:
+            for i in range(0, len(windows), step):
+                W = (position[None, :] < prefix[i:i + step, None]) & rows
+                r, n = batched_spearman(x, y, W, x_blocks, y_blocks)
+                results.append(pd.DataFrame({group_col: name, 'Algorithm': t, 'Survey': s,
+                                             'Window': windows[i:i + step],
+                                             'Correlation': r.round(4), 'n': n.astype('int64')}))
+
+    if not results:
+        return pd.DataFrame(columns=[group_col, 'Algorithm', 'Survey', 'Window', 'Correlation', 'n'])
+    return pd.concat(results, ignore_index=True)
+
+
+def kernel_weights(time_diff, mins, kernel):
+    # Weight of each linked pair; pairs outside the window get none
+    u = np.abs(np.asarray(time_diff, dtype='float64')) / mins
+    return np.where(u <= 1, linkage_kernels[kernel](u), 0.0)
 
-    return merge2
+
+def _row_weights(df, weights):
+    # Weights given as a column name or as one value per row (None: unweighted)
+    if weights is None:
+        return None
+    values = df[weights] if isinstance(weights, str) else weights
+    return np.asarray(values, dtype='float64')
 
 
 # ---- PREPARE LONG FILES FOR PLOTS WITH USERGROUPS ---- #
 
 # To create a multi-column plot you have to make the data long
 
+@instrumented()
 def make_long_raw(df):
 
     # Raw Data
@@ -136,6 +573,7 @@ def make_long_raw(df):
     return matched_raw_long
 
 
+@instrumented()
 def make_long_scaled(df):
     # Scaled
     algo = df.melt(id_vars=['userId', 'userGroup'],
@@ -157,65 +595,310 @@ def make_long_scaled(df):
 
 # ---- CROSSTAB OF THE LOW/MEDIUM/IGH FOR ALGORITH VS. SURVEY ---- #
 
-def consistency_counts(df, textCol, svyCol):
-    res = df.groupby([textCol, svyCol]).size().reset_index().rename(
-        columns=({textCol: 'Algorithm', svyCol: 'Survey', 0: 'Count'}))
+def consistency_counts(df, textCol, svyCol, weights=None):
+    w = _row_weights(df, weights)
+    if w is None:
+        res = df.groupby([textCol, svyCol]).size().reset_index().rename(
+            columns=({textCol: 'Algorithm', svyCol: 'Survey', 0: 'Count'}))
+    else:
+        # Weighted counts: the sum of the weights of the pairs in each cell
+        res = pd.Series(w, index=df.index).groupby([df[textCol], df[svyCol]]).sum().round(2) \
+            .reset_index().rename(columns=({textCol: 'Algorithm', svyCol: 'Survey', 0: 'Count'}))
 
     res['%'] = round((res['Count'] / res.groupby(['Algorithm'])
                      ['Count'].transform('sum')) * 100, 1)
     return res
 
 
-# ---- SPEARMAN CORRELATIONS ---- #
+def _as_categorical(col):
+    return col.values if hasattr(col, 'cat') else pd.Categorical(col)
 
-def spearman_corr(data, emotions_list):
-    corr = data[emotions_list].corr(method='spearman')
-    return corr
 
+@instrumented()
+def consistency_cube(df, textcols, svycols, names=None, group_col='userGroup', groups=None,
+                     weights=None):
 
-def corr_by_subjectivity(df, textlist, svylist):
+    # Counts and row % of every emotion x user group (plus 'All') x algorithm
+    # group x survey group, from one bincount over all the emotions together
+    # (with weights, the counts are sums of the weights)
+    names = names or textcols
+    w = _row_weights(df, weights)
+    groups = list(groups) if groups is not None else sorted(df[group_col].dropna().unique())
 
-    corr_results = pd.DataFrame()
+    # Rows outside the listed groups still count towards 'All'
+    gcode = pd.Categorical(df[group_col], categories=groups).codes.astype('int64')
+    gcode[gcode < 0] = len(groups)
+    n_groups = len(groups) + 1
 
-    for t, s in zip(textlist, svylist):
-        for time in np.arange(0.1, 1.0, 0.1):
-            time = time.round(3)
-            temp = df[df['subjectivity'] >= time]
-            corr = temp[[t, s]].corr(method='spearman')
-            result = corr.iloc[0, 1].round(4)
-            res = pd.DataFrame({'Algorithm': [t], 'Survey': [s], 'Correlation': [
-                               result], 'Subjectivity': [time]})
-            corr_results = corr_results.append(res)
-    return corr_results.pivot(index=['Algorithm', 'Survey'], columns='Subjectivity', values='Correlation')
+    flat, flat_w, shapes, offset = [], [], [], 0
+    for t, s in zip(textcols, svycols):
+        a, b = _as_categorical(df[t]), _as_categorical(df[s])
+        n_a, n_b = len(a.categories), len(b.categories)
+        ok = (a.codes >= 0) & (b.codes >= 0)
+        flat.append(offset + ((gcode * n_a + a.codes) * n_b + b.codes)[ok])
+        if w is not None:
+            flat_w.append(w[ok])
+        shapes.append((a.categories, b.categories, offset))
+        offset += n_groups * n_a * n_b
 
+    counts = np.bincount(np.concatenate(flat) if flat else np.array([], dtype='int64'),
+                         weights=np.concatenate(flat_w) if w is not None and flat else None,
+                         minlength=offset)
+    if w is not None:
+        counts = counts.round(2)
 
-def corr_by_polarity(df, textlist, svylist):
+    pieces = []
+    for name, (a_cats, b_cats, start) in zip(names, shapes):
+        n_a, n_b = len(a_cats), len(b_cats)
+        cnt = counts[start:start + n_groups * n_a * n_b].reshape(n_groups, n_a, n_b)
+        cnt = np.concatenate([cnt.sum(axis=0, keepdims=True), cnt[:-1]])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            pct = np.round(cnt / cnt.sum(axis=2, keepdims=True) * 100, 1)
+        index = pd.MultiIndex.from_product([[name], ['All'] + groups, list(a_cats), list(b_cats)],
+                                           names=['Emotion', group_col, 'Algorithm', 'Survey'])
+        pieces.append(pd.DataFrame({'Count': cnt.ravel(), '%': pct.ravel()}, index=index))
 
-    corr_results = pd.DataFrame()
+    return pd.concat(pieces).reset_index()
 
-    for t, s in zip(textlist, svylist):
-        for time in np.arange(-1, 1.2, 0.2):
-            time = time.round(3)
-            temp = df[df['polarity'] >= time]
-            corr = temp[[t, s]].corr(method='spearman')
-            result = corr.iloc[0, 1].round(4)
-            res = pd.DataFrame({'Algorithm': [t], 'Survey': [
-                               s], 'Correlation': [result], 'Polarity': [time]})
-            corr_results = corr_results.append(res)
-    return corr_results.pivot(index=['Algorithm', 'Survey'], columns='Polarity', values='Correlation')
 
+def consistency_slice(cube, emotion, group='All', group_col='userGroup'):
+    res = cube[(cube['Emotion'] == emotion) & (cube[group_col] == group)]
+    return res[['Algorithm', 'Survey', 'Count', '%']].reset_index(drop=True)
 
-def corr_by_words(df, textlist, svylist):
 
-    corr_results = pd.DataFrame()
+# ---- SPEARMAN CORRELATIONS ---- #
 
+def spearman_corr(data, emotions_list, weights=None):
+    w = _row_weights(data, weights)
+    if w is None:
+        return data[emotions_list].corr(method='spearman')
+
+    # Weighted: every pair of columns from the batched ranks
+    corr = pd.DataFrame(np.eye(len(emotions_list)), index=emotions_list, columns=emotions_list)
+    values = data[emotions_list].to_numpy(dtype='float64')
+    if not np.isnan(values).any():
+        # No missing values: rank each column once, then one weighted
+        # covariance matrix of the ranks
+        W = w[None, :]
+        ranks = np.stack([_batched_ranks(_tie_blocks(col), W)[0] for col in values.T], axis=1)
+        centred = ranks - (w @ ranks) / w.sum()
+        cov = (centred * w[:, None]).T @ centred
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sd = np.sqrt(np.diag(cov))
+            corr.loc[:, :] = cov / np.outer(sd, sd)
+        return corr
+    # Missing values: pairwise complete, as .corr
+    for i, j in zip(*np.triu_indices(len(emotions_list), 1)):
+        r = batched_spearman(values[:, i], values[:, j], w)[0][0]
+        corr.iloc[i, j] = corr.iloc[j, i] = r
+    return corr
+
+
+# Batched rank correlations: rather than filtering the data and calling .corr
+# once per subset, every subset is a row of weights over the same rows (0/1 for
+# a filter, counts for a resample) and all of them are ranked in one go.
+# Ranks are the tie-averaged ranks of the weighted rows, as in .rank().
+
+def _tie_blocks(x):
+    # Sort once: the order of x and the runs of tied values in that order
+    order = np.argsort(x, kind='mergesort')
+    xs = x[order]
+    starts = np.flatnonzero(np.r_[True, xs[1:] != xs[:-1]]) if len(x) else np.array([], dtype=int)
+    block_of = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(x)]))
+    return order, starts, block_of
+
+
+def _batched_ranks(blocks, W):
+    order, starts, block_of = blocks
+    ranks = np.empty_like(W)
+    if W.shape[1] == 0:
+        return ranks
+    block_w = np.add.reduceat(W[:, order], starts, axis=1)
+    block_rank = np.cumsum(block_w, axis=1) - block_w / 2
+    ranks[:, order] = block_rank[:, block_of]
+    return ranks
+
+
+def _weighted_pearson(a, b, W):
+    n = W.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        da = a - ((W * a).sum(axis=1) / n)[:, None]
+        db = b - ((W * b).sum(axis=1) / n)[:, None]
+        r = (W * da * db).sum(axis=1) / np.sqrt((W * da * da).sum(axis=1) *
+                                                (W * db * db).sum(axis=1))
+    return r
+
+
+def batched_spearman(x, y, W, x_blocks=None, y_blocks=None):
+
+    # Spearman correlation of x and y under each row of the weights W (k x n).
+    # Rows where x or y is missing get no weight (pairwise complete, as .corr).
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    W = np.atleast_2d(np.asarray(W, dtype='float64'))
+
+    missing = np.isnan(x) | np.isnan(y)
+    if missing.any():
+        W = W * ~missing
+        x, y = np.where(missing, 0, x), np.where(missing, 0, y)
+        x_blocks = y_blocks = None
+
+    rx = _batched_ranks(x_blocks or _tie_blocks(x), W)
+    ry = _batched_ranks(y_blocks or _tie_blocks(y), W)
+    r = _weighted_pearson(rx, ry, W)
+
+    # With fewer than 2 rows there is no correlation
+    n = W.sum(axis=1)
+    r[n < 2] = np.nan
+    return r, n
+
+
+def _cluster_draws(rng, in_group, n_boot):
+    # Bootstrap resamples of the clusters (users) in the group: how many times
+    # each cluster is drawn, with a last column of zeros for rows with no cluster
+    draws = np.zeros((n_boot, len(in_group) + 1))
+    members = np.flatnonzero(in_group)
+    if len(members):
+        draws[:, members] = rng.multinomial(len(members), np.full(len(members), 1 / len(members)),
+                                            size=n_boot)
+    return draws
+
+
+def _boot_interval(x, y, codes, w, keep, draws, tail, max_cells):
+    # Percentile interval of the correlation over the resamples (draws) of the
+    # rows in keep. Only those rows are ranked: the others would get no weight
+    # in any resample.
+    if not len(draws):
+        return np.nan, np.nan
+    xs, ys, cs, ws = x[keep], y[keep], codes[keep], w[keep]
+    x_blocks, y_blocks = _tie_blocks(xs), _tie_blocks(ys)
+    step = max(1, max_cells // max(len(xs), 1))
+    boot = np.concatenate([batched_spearman(xs, ys, draws[i:i + step][:, cs] * ws, x_blocks, y_blocks)[0]
+                           for i in range(0, len(draws), step)])
+    boot = boot[np.isfinite(boot)]
+    return tuple(np.quantile(boot, [tail, 1 - tail])) if len(boot) else (np.nan, np.nan)
+
+
+@instrumented()
+def bootstrap_spearman(df, textlist, svylist, n_boot=500, level=0.95, cluster='userId',
+                       group_col='userGroup', groups=(), seed=0, max_cells=4000000, weights=None):
+
+    # Percentile confidence intervals of the Spearman correlation of each
+    # Algorithm/Survey pair, among all rows and within each group. Users are
+    # resampled rather than rows (a user's rows go in or out together): each
+    # resample is a row of weights, the number of times the row's user was
+    # drawn, and all the resamples of a pair are ranked in one go.
+    codes, users = pd.factorize(df[cluster])
+    w = _row_weights(df, weights)
+    w = np.ones(len(df)) if w is None else w
+    user_group = pd.Series(df[group_col].to_numpy()).groupby(codes).first() if len(groups) else None
+    rng = np.random.default_rng(seed)
+    tail = (1 - level) / 2
+
+    # The same resamples are used for every pair
+    subsets = [('All', np.ones(len(df), dtype=bool), _cluster_draws(rng, np.ones(len(users), dtype=bool), n_boot))]
+    for group in groups:
+        in_group = (user_group.reindex(range(len(users))) == group).to_numpy()
+        subsets.append((group, (df[group_col] == group).to_numpy(), _cluster_draws(rng, in_group, n_boot)))
+
+    results = []
+    for t, s in zip(textlist, svylist):
+        x = df[t].to_numpy(dtype='float64')
+        y = df[s].to_numpy(dtype='float64')
+        complete = ~(np.isnan(x) | np.isnan(y))
+        for name, rows, draws in subsets:
+            keep = rows & complete
+            cs = codes[keep]
+            point, n = batched_spearman(x[keep], y[keep], w[keep][None, :])
+            low, high = _boot_interval(x, y, codes, w, keep, draws, tail, max_cells)
+            results.append({group_col: name, 'Algorithm': t, 'Survey': s,
+                            'Correlation': round(point[0], 4),
+                            'CI low': round(low, 4), 'CI high': round(high, 4),
+                            'n': int(n[0]) if weights is None else round(n[0], 2),
+                            'Users': len(np.unique(cs[cs >= 0]))})
+
+    return pd.DataFrame(results)
+
+
+def ci_table(boot, group_col='userGroup'):
+    # One row per pair, one column per group: "r (low, high)"
+    cells = boot.assign(CI=[f'{r:.3f} ({lo:.3f}, {hi:.3f})' for r, lo, hi in
+                            zip(boot['Correlation'], boot['CI low'], boot['CI high'])])
+    pairs = pd.MultiIndex.from_frame(boot[['Algorithm', 'Survey']].drop_duplicates())
+    return cells.pivot(index=['Algorithm', 'Survey'], columns=group_col,
+                       values='CI').reindex(pairs)[list(pd.unique(boot[group_col]))]
+
+
+@instrumented()
+def corr_sweep(df, filter_col, thresholds, textlist, svylist, label='Threshold', max_cells=4000000,
+               weights=None, n_boot=0, level=0.95, cluster='userId', seed=0):
+
+    # Spearman correlation of each Algorithm/Survey pair among the rows where
+    # filter_col >= threshold, for every threshold at once (with weights, n is
+    # the sum of the weights). With n_boot, each also gets a percentile
+    # bootstrap interval, resampling users as bootstrap_spearman does (the
+    # same resamples for every pair and threshold).
+    values = df[filter_col].to_numpy(dtype='float64')
+    w = _row_weights(df, weights)
+    thresholds = np.asarray(thresholds)
+
+    # Thresholds are handled in blocks to bound memory on large matched sets
+    step = max(1, max_cells // max(len(values), 1))
+
+    codes, users = pd.factorize(df[cluster])
+    draws = _cluster_draws(np.random.default_rng(seed), np.ones(len(users), dtype=bool), n_boot)
+    w_boot = np.ones(len(df)) if w is None else w
+    tail = (1 - level) / 2
+    intervals = ['CI low', 'CI high'] if n_boot else []
+
+    results = []
     for t, s in zip(textlist, svylist):
-        for time in np.arange(0, 50, 5):
-            time = time.round(3)
-            temp = df[df['word_count'] >= time]
-            corr = temp[[t, s]].corr(method='spearman')
-            result = corr.iloc[0, 1].round(4)
-            res = pd.DataFrame({'Algorithm': [t], 'Survey': [s], 'Correlation': [
-                               result], 'Word Count': [time]})
-            corr_results = corr_results.append(res)
-    return corr_results.pivot(index=['Algorithm', 'Survey'], columns='Word Count', values='Correlation')
+        x = df[t].to_numpy(dtype='float64')
+        y = df[s].to_numpy(dtype='float64')
+        x_blocks, y_blocks = _tie_blocks(x), _tie_blocks(y)
+        for i in range(0, len(thresholds), step):
+            block = thresholds[i:i + step]
+            with np.errstate(invalid='ignore'):
+                W = values[None, :] >= block[:, None]
+            if w is not None:
+                W = W * w
+            r, n = batched_spearman(x, y, W, x_blocks, y_blocks)
+            res = pd.DataFrame({'Algorithm': t, 'Survey': s,
+                                'Correlation': r.round(4),
+                                label: block, 'n': n.astype('int64') if w is None else n.round(2)})
+            if n_boot:
+                complete = ~(np.isnan(x) | np.isnan(y))
+                with np.errstate(invalid='ignore'):
+                    bounds = [_boot_interval(x, y, codes, w_boot, (values >= threshold) & complete,
+                                             draws, tail, max_cells) for threshold in block]
+                res['CI low'], res['CI high'] = np.round(bounds, 4).T
+            results.append(res)
+
+    if not results:
+        return pd.DataFrame(columns=['Algorithm', 'Survey', 'Correlation', label, 'n'] + intervals)
+    return pd.concat(results, ignore_index=True)
+
+
+def corr_sweep_table(sweep, label):
+    values = ['Correlation'] + [col for col in ['CI low', 'CI high'] if col in sweep] + ['n']
+    table = sweep.pivot(index=['Algorithm', 'Survey'], columns=label, values=values)
+    n_type = 'int64' if sweep['n'].dtype.kind == 'i' else 'float64'
+    return table.astype({col: n_type for col in table.columns if col[0] == 'n'})
+
+
+def corr_by_subjectivity(df, textlist, svylist, weights=None, n_boot=0):
+    sweep = corr_sweep(df, 'subjectivity', subjectivity_thresholds,
+                       textlist, svylist, 'Subjectivity', weights=weights, n_boot=n_boot)
+    return corr_sweep_table(sweep, 'Subjectivity')
+
+
+def corr_by_polarity(df, textlist, svylist, weights=None, n_boot=0):
+    sweep = corr_sweep(df, 'polarity', polarity_thresholds,
+                       textlist, svylist, 'Polarity', weights=weights, n_boot=n_boot)
+    return corr_sweep_table(sweep, 'Polarity')
+
+
+def corr_by_words(df, textlist, svylist, weights=None, n_boot=0):
+    sweep = corr_sweep(df, 'word_count', word_thresholds,
+                       textlist, svylist, 'Word Count', weights=weights, n_boot=n_boot)
+    return corr_sweep_table(sweep, 'Word Count')
@@ -9,179 +9,545 @@
 
 # ---- IMPORTS ---- #
 
+import functools
+import logging
+import os
+import threading
+
+import numpy as np
 import pandas as pd
-from textblob import TextBlob
-from sklearn.preprocessing import MinMaxScaler
-import streamlit as st
-from functools import reduce
 from functions import *
+from snapshot import *
+from sentiment_cache import cached_sentiment
+from normalizer import ScoreNormalizer
+from scoring import score_items, deq_scoring, daily_moods_scoring
+from instrument import instrumented
+
+
+# ---- SOURCE FILES ---- #
+
+keyboard_csv = "Pilot Keyboard Input Cleaned 5 emotions.csv"
+mood_csv = "Pilot Mood Survey.csv"
+deq_csv = "Pilot DEQ Data.csv"
+
+# Emotion scores are normalised over all rows, or within each user ('userId')
+# or user group ('userGroup')
+normalise_by = os.environ.get('FRANK_NORMALISE_BY') or None
+
+# Bump this whenever the preparation below changes, so old snapshots are rebuilt
+# (snapshots normalised within users or groups are kept apart)
+pipeline_version = 6 if normalise_by is None else f'6-{normalise_by}'
+
+# Processes used for the sentiment analysis (unset = one per CPU)
+sentiment_workers = int(os.environ.get('FRANK_SENTIMENT_WORKERS', 0)) or None
+
+# Invalid survey answers are left out with a warning ('coerce'), or stop the
+# preparation ('raise', e.g. python getdata.py --strict to check a new export)
+survey_errors = os.environ.get('FRANK_SURVEY_ERRORS', 'coerce')
+
+logger = logging.getLogger(__name__)
+
+
+# ---- LAZY LOADING ---- #
+
+# Nothing is prepared when this module is imported. Each load_*() function
+# builds its frame on first use (along with only the frames it needs), then
+# keeps it in memory and in the on-disk snapshot, keyed by its own source files.
+# The frame in memory is built again once any of those files changes (a new
+# export), so a running app never serves the frames of the old export.
+
+def source_stamp(paths):
+    return tuple((os.path.basename(path), os.stat(path).st_mtime_ns, os.stat(path).st_size)
+                 for path in paths)
+
+
+def memoized(build, sources=()):
+    lock = threading.Lock()
+    held = {}
+
+    @functools.wraps(build)
+    def load():
+        stamp = source_stamp(sources)
+        with lock:
+            if 'frame' not in held or held['stamp'] != stamp:
+                held['frame'], held['stamp'] = build(), stamp
+            return held['frame']
+
+    load.cache_clear = held.clear
+    return load
+
+
+def snapshotted(name, *sources, incremental=False):
+
+    # An incremental frame is refreshed from its previous snapshot when the new
+    # export is the old file with rows appended (its first source starts with
+    # exactly the bytes the snapshot was built from): the builder gets the
+    # previous snapshot so the rows it holds do not have to be prepared again.
+    # Any other change to the file rebuilds the frame in full.
+    def decorator(build):
+        @functools.wraps(build)
+        def load():
+            key = snapshot_key(sources, pipeline_version)
+            df = read_snapshot(name, key)
+            if df is None:
+                if not incremental:
+                    df = build()
+                    write_snapshot(name, key, df, version=pipeline_version)
+                else:
+                    prefix = file_prefix(sources[0])
+                    previous = read_previous(name, pipeline_version)
+                    if previous is not None and not has_prefix(sources[0], previous[1]):
+                        logger.info('%s: earlier rows of %s have changed, preparing all rows',
+                                    name, os.path.basename(sources[0]))
+                        previous = None
+                    df = build(previous)
+                    write_snapshot(name, key, df, version=pipeline_version, **(prefix or {}),
+                                   **df.attrs.get('snapshot_meta', {}))
+            return df
+        return memoized(load, sources)
+    return decorator
+
+
+def split_at_previous(df, previous, name):
+
+    # Rows already held by the previous snapshot. The export only had rows
+    # appended, so these are the rows at the same file positions (row labels).
+    seen = np.zeros(len(df), dtype=bool)
+    if previous is None:
+        return seen, None
+
+    old, meta = previous
+    seen = df.index.isin(old.index)
+    if seen.sum() != len(old):
+        logger.info('%s: the previous rows are not all there, preparing all %d rows', name, len(df))
+        return np.zeros(len(df), dtype=bool), None
 
+    logger.info('%s: %d of %d rows are new', name, (~seen).sum(), len(df))
+    return seen, old
+
+
+def carry_forward(df, seen, old, new, cols):
+    # Derived columns for every row: from the previous snapshot for the rows it
+    # holds, freshly computed for the newer rows
+    if old is None:
+        return new[cols]
+    kept = old[cols].reindex(df.index[seen])
+    return pd.concat([kept, new[cols]]).reindex(df.index)
+
+
+def normalise(df, columns, scaled, ranked):
+    # Min-max scaled, percentile rank and tertile group columns, fitted on
+    # these rows in one pass over all the emotions
+    normalizer = ScoreNormalizer(columns, scaled, ranked, by=normalise_by)
+    for col, values in normalizer.fit_transform(df).items():
+        df[col] = values
+    return df
 
-# ---- INITIALISE THE SCALER ---- #
 
-scaler = MinMaxScaler()
+# ---- INPUT TEXT DATA PREPARATION (RAW) ---- #
 
+def clean_keyboard(df):
 
-# ---- INPUT TEXT DATA PREPARATION (RAW) ---- #
+    # Every second row was missing, remove these
+    df.dropna(subset=["inputTime"], inplace=True)
 
-# Read in the keyboard input data
-df = pd.read_csv("Pilot Keyboard Input Cleaned 5 emotions.csv")
+    # Get the date and time
+    df['inputTime'] = pd.to_datetime(df['inputTime'], format='%Y-%m-%d-%H-%M-%S')
 
-# Every second row was missing, remove these
-df.dropna(subset=["inputTime"], inplace=True)
+    return df
 
-# Get the date and time
-df['inputTime'] = pd.to_datetime(df['inputTime'], format='%Y-%m-%d-%H-%M-%S')
 
-# Count the number of words in each input
-df['word_count'] = df['inputText'].str.split().str.len()
+@instrumented()
+def read_csv(path, **kwargs):
+    return pd.read_csv(path, **kwargs)
 
-# Make all text lowercase
-df['inputText'] = df['inputText'].str.lower()
 
-# Sentiment analysis - this is crude without stopwords removed or lemmitization etc
-df['polarity'] = df['inputText'].apply(detect_polarity)
-df['subjectivity'] = df['inputText'].apply(detect_subjectivity)
+@instrumented()
+def read_keyboard(usecols=None):
 
-# Normalise the emotions using Min Max scaling (values will be from 0 - 1)
-df[emotions_txt_sc] = scaler.fit_transform(df[emotions_txt])
+    # Read in the keyboard input data
+    return clean_keyboard(read_csv(keyboard_csv, usecols=usecols))
 
-# Normalise the emotions using percentile rank
-df[emotions_txt_rk] = df[emotions_txt].rank(pct=True)
-# Put into 3 groups (Low, Medium, High)
-for i in emotions_txt_rk:
-    colname = i + '_grp'
-    df[colname] = bins3(df, i)
 
-# Create final dataframe to use in matching
-text_df = df.copy()
+@instrumented()
+def score_text(df, cache_path=None):
 
-# Get the number of text inputs per hour
-text_by_hr = text_df.groupby(text_df['inputTime'].dt.hour).size(
-).reset_index().rename(columns={0: 'Inputs (n)', 'inputTime': 'Hour'})
-text_hravg_txt = text_df.groupby(text_df['inputTime'].dt.hour)[
-    emotions_txt].mean().reset_index().rename(columns={'inputTime': 'Hour'})
-text_hravg_txt_sc = text_df.groupby(text_df['inputTime'].dt.hour)[
-    emotions_txt_sc].mean().reset_index().rename(columns={'inputTime': 'Hour'})
+    # Count the number of words in each input
+    df['word_count'] = df['inputText'].str.split().str.len()
 
-del df
+    # Sentiment analysis - this is crude without stopwords removed or lemmitization etc
+    # (texts already scored in earlier runs come from the sentiment cache)
+    df[['polarity', 'subjectivity']] = cached_sentiment(df['inputText'],
+                                                       workers=sentiment_workers,
+                                                       path=cache_path)
 
-# ---- INPUT TEXT DATA PREPARATION (ROLLED UP ACROSS THE INPUT TIME FOR EACH RECORD) ---- #
+    return df
+
+
+@instrumented()
+def normalise_text(df):
+
+    # Normalise the emotions using Min Max scaling (values will be from 0 - 1)
+    # and percentile rank, and put the ranks into 3 groups (Low, Medium, High)
+    return normalise(df, emotions_txt, emotions_txt_sc, emotions_txt_rk)
+
+
+@snapshotted('text_df', keyboard_csv, incremental=True)
+def load_text(previous=None):
+
+    df = read_keyboard()
+
+    # Make all text lowercase
+    df['inputText'] = df['inputText'].str.lower()
+
+    # Only the rows newer than the previous snapshot need word counts and sentiment
+    seen, old = split_at_previous(df, previous, 'text_df')
+    new = score_text(df.loc[~seen, ['inputText']].copy())
+
+    df[['word_count', 'polarity', 'subjectivity']] = carry_forward(
+        df, seen, old, new, ['word_count', 'polarity', 'subjectivity'])
+
+    # Final dataframe to use in matching
+    return compact(normalise_text(df))
+
+
+# The hourly summaries are slices of the text temporal cube (see below)
+def load_text_by_hr():
+    return cube_slice(load_text_cube(), 'Text')
 
-# Roll up the emotions
-emot_rollup = text_df.groupby(['userId', 'userGroup', 'inputTime'])[
-    ['Anger', 'Sadness', 'Fear', 'Joy', 'Disgust', 'polarity', 'subjectivity']].max().reset_index()
-# Roll up the text input
-words_rollup = text_df.groupby(['userId', 'userGroup', 'inputTime'])[
-    'inputText'].apply('; '.join).reset_index()
-# Get the word count
-words_rollup['word_count'] = words_rollup['inputText'].str.split().str.len()
-# Merge together
-df = pd.merge(emot_rollup, words_rollup, how='left',
-              on=['userId', 'userGroup', 'inputTime'])
 
-# Normalise the emotions using Min Max scaling (values will be from 0 - 1)
-df[emotions_txt_sc] = scaler.fit_transform(df[emotions_txt])
+def load_text_hravg_txt():
+    return cube_slice(load_text_cube(), 'Text', values=emotions_txt).drop(columns='Inputs (n)')
 
-# Normalise the emotions using percentile rank
-df[emotions_txt_rk] = df[emotions_txt].rank(pct=True)
-# Put into 3 groups (Low, Medium, High)
-for i in emotions_txt_rk:
-    colname = i + '_grp'
-    df[colname] = bins3(df, i)
 
-# Create final dataframe to use in matching
-text_rollup_df = df.copy()
+def load_text_hravg_txt_sc():
+    return cube_slice(load_text_cube(), 'Text', values=emotions_txt_sc).drop(columns='Inputs (n)')
 
-del df
+
+@snapshotted('text_hours', keyboard_csv)
+def load_text_hours():
+
+    # Hours with text inputs, from the input times alone (no sentiment needed)
+    hours = read_keyboard(usecols=['inputTime'])['inputTime'].dt.hour
+    return pd.DataFrame({'Hour': np.sort(hours.unique())})
+
+
+# ---- INPUT TEXT DATA PREPARATION (ROLLED UP ACROSS THE INPUT TIME FOR EACH RECORD) ---- #
+
+@instrumented()
+def rollup_rows(text_df):
+
+    # Roll up the emotions (maximum), join the text input and add up the word
+    # counts in one pass over the records
+    return rollup(text_df, ['userId', 'userGroup', 'inputTime'], rollup_aggregations)
+
+
+@snapshotted('text_rollup_df', keyboard_csv, incremental=True)
+def load_rollup(previous=None):
+
+    text_df = load_text()
+    keys = ['userId', 'userGroup', 'inputTime']
+
+    # The previous snapshot rolled up the inputs before file position
+    # 'source_rows'. Only the records the appended inputs belong to (new ones,
+    # or old ones they add to) are rolled up again, from all their inputs.
+    df = None
+    if previous is not None and 'source_rows' in previous[1]:
+        old, meta = previous
+        added = text_df[text_df.index >= meta['source_rows']]
+        touched = pd.MultiIndex.from_frame(added[keys])
+        redo = pd.MultiIndex.from_frame(text_df[keys]).isin(touched)
+        keep = ~pd.MultiIndex.from_frame(old[keys]).isin(touched)
+        logger.info('text_rollup_df: rolling up %d records again for %d new inputs',
+                    len(touched.unique()), len(added))
+        pieces = [old.loc[keep, keys + list(rollup_aggregations)]]
+        if redo.any():
+            pieces.append(rollup_rows(text_df[redo]))
+        df = pd.concat(pieces).sort_values(
+            keys, kind='mergesort').reset_index(drop=True)
+    if df is None:
+        df = rollup_rows(text_df)
+    df.attrs['snapshot_meta'] = {'source_rows': int(text_df.index.max()) + 1 if len(text_df) else 0}
+
+    # Final dataframe to use in matching
+    return compact(normalise_text(df))
+
+
+# ---- STREAMING PREPARATION FOR LARGE KEYBOARD EXPORTS ---- #
+
+def stream_keyboard(path=keyboard_csv, chunksize=50000):
+
+    # The keyboard inputs prepared chunk by chunk (blank rows dropped, times
+    # parsed, text lowercased, words counted and sentiment scored), so only one
+    # chunk of the file is ever held in memory
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk = clean_keyboard(chunk)
+        chunk['inputText'] = chunk['inputText'].str.lower()
+        yield score_text(chunk)
+
+
+def prepare_keyboard_stream(path=keyboard_csv, chunksize=50000, out_path=None):
+
+    # Builds the text temporal cube, the text hours and the rolled up records
+    # from the stream, so the raw inputs are never all in memory: only one
+    # chunk of them, plus the partial cube and roll up of every chunk so far.
+    # The partial roll ups (and their final combination) hold every record, so
+    # peak memory still grows with the number of records in the file, not just
+    # with the chunk size. The prepared rows can be written to a Parquet file
+    # as they go.
+    keys = ['userId', 'userGroup', 'inputTime']
+
+    # Emotions are scaled within each normalise_by group (or over all rows),
+    # so the chunk cubes are kept apart by it until the scaling is known
+    by = [normalise_by] if normalise_by else []
+    parts, cubes, ranges, hours, writer, source_rows = [], [], [], set(), None, 0
+
+    for chunk in stream_keyboard(path, chunksize):
+        if len(chunk):
+            source_rows = int(chunk.index.max()) + 1
+
+        # Partial cube of this chunk, the lowest / highest emotions of each
+        # scaling group and the hours with inputs
+        cubes.append(temporal_cube(chunk, 'Text', 'inputTime', emotions_txt, by=by))
+        group = chunk[normalise_by] if by else pd.Series('All', index=chunk.index)
+        ranges.append(chunk[emotions_txt].groupby(group).agg(['min', 'max']))
+        hours.update(chunk['inputTime'].dt.hour.unique())
+
+        # Partial roll up of this chunk (records can carry on into the next chunk)
+        parts.append(partial_rollup(chunk, keys))
+
+        if out_path is not None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index=False,
+                                         schema=writer.schema if writer else None)
+            writer = writer or pq.ParquetWriter(out_path, table.schema)
+            writer.write_table(table)
+
+    if writer is not None:
+        writer.close()
+
+    # Combine the chunk cubes. Min-max scaling is linear, so the sums of the
+    # scaled emotions follow from the raw sums and counts of each cell:
+    # (sum - n x lowest) / (highest - lowest) within its scaling group
+    text_cube = stream_cube(cubes, ranges, by)
+    text_hours = pd.DataFrame({'Hour': np.sort(np.array(list(hours), dtype='int64'))})
+
+    # Combine the partial roll ups, in file order so the texts join as before
+    # (max of maxes, sum of sums, joins of joins and sums / counts for means
+    # give the full roll up)
+    df = combine_rollups(parts, keys) if parts else \
+        pd.DataFrame(columns=keys + list(rollup_aggregations))
+
+    # File positions covered, as recorded by load_rollup's snapshot
+    rolled = compact(normalise_text(df))
+    rolled.attrs['snapshot_meta'] = {'source_rows': source_rows}
+
+    return {'text_cube': text_cube,
+            'text_hours': text_hours,
+            'text_rollup_df': rolled}
+
+
+def stream_cube(cubes, ranges, by):
+
+    # The text cube from the cubes of the chunks (kept apart by the scaling
+    # groups `by`) and the lowest / highest emotions of each scaling group
+    cells = ['Inputs (n)'] + [col + part for col in emotions_txt + emotions_txt_sc for part in ('_sum', '_n')]
+    if not cubes:
+        return pd.DataFrame(columns=cube_dims + cells)
+    raw = [col for col in cubes[0].columns if col not in cube_dims + by]
+    cube = pd.concat(cubes).groupby(cube_dims + by)[raw].sum().reset_index()
+
+    ranges = pd.concat(ranges).groupby(level=0).agg({**{(col, 'min'): 'min' for col in emotions_txt},
+                                                     **{(col, 'max'): 'max' for col in emotions_txt}})
+    group = cube[by[0]] if by else pd.Series('All', index=cube.index)
+    for col, scaled in zip(emotions_txt, emotions_txt_sc):
+        lowest = ranges[(col, 'min')].reindex(group).to_numpy()
+        span = ranges[(col, 'max')].reindex(group).to_numpy() - lowest
+        span[span == 0] = 1
+        cube[scaled + '_sum'] = (cube[col + '_sum'] - cube[col + '_n'] * lowest) / span
+        cube[scaled + '_n'] = cube[col + '_n']
+
+    # Sum out the scaling groups
+    return cube.groupby(cube_dims)[cells].sum().reset_index()
+
+
+def refresh_from_stream(path=keyboard_csv, chunksize=50000, out_path=None):
+
+    # Rebuilds the text_rollup_df, text_cube and text_hours snapshots from the
+    # stream, for keyboard exports too large to prepare as one frame (their
+    # loaders then read them and never build the raw text frame)
+    prefix = file_prefix(path)
+    frames = prepare_keyboard_stream(path, chunksize, out_path)
+    key = snapshot_key((path,), pipeline_version)
+    rolled = frames['text_rollup_df']
+    write_snapshot('text_rollup_df', key, rolled, version=pipeline_version, **(prefix or {}),
+                   **rolled.attrs['snapshot_meta'])
+    for name in ['text_cube', 'text_hours']:
+        write_snapshot(name, key, frames[name], version=pipeline_version)
+    return frames
 
 
 # ---- DAILY MOODS DATA PREPARATION ---- #
 
-# Read in the keyboard input data
-df = pd.read_csv("Pilot Mood Survey.csv")
+@instrumented()
+def prepare_daily_moods(df):
+
+    # Get the date and time
+    df['surveyTime'] = pd.to_datetime(df['surveyTime'], format='%Y-%m-%d-%H-%M-%S')
+
+    # Check the ratings (every invalid one is reported together)
+    df[emotions_svy] = score_items(df, daily_moods_scoring, errors=survey_errors)[emotions_svy]
 
-# Get the date and time
-df['surveyTime'] = pd.to_datetime(df['surveyTime'], format='%Y-%m-%d-%H-%M-%S')
+    # Normalise the emotions using Min Max scaling (values will be from 0 - 1)
+    # and percentile rank, and put the ranks into 3 groups (Low, Medium, High;
+    # tertiles left empty by ties, as for Disgust, are merged)
+    normalise(df, emotions_svy, emotions_svy_sc, emotions_svy_rk)
 
-# Normalise the emotions using Min Max scaling (values will be from 0 - 1)
-df[emotions_svy_sc] = scaler.fit_transform(df[emotions_svy])
+    # Final dataframe to use in matching
+    return compact(df[user_time + user_info + emotions_svy + emotions_svy_sc +
+                      emotions_svy_rk + emotions_svy_rk_grp])
 
-# Normalise the emotions using percentile rank
-df[emotions_svy_rk] = df[emotions_svy].rank(pct=True)
-# Put into 3 groups (Low, Medium, High)
-for i in emotions_svy_rk:
-    colname = i + '_grp'
-    df[colname] = bins3_dm(df, i)
 
-# Create final dataframe to use in matching
-dm_df = df[user_time + emotions_svy + emotions_svy_sc +
-           emotions_svy_rk + emotions_svy_rk_grp].copy()
+@snapshotted('dm_df', mood_csv)
+def load_daily_moods():
 
-# Get the number of daily mood inputs per hour
-dm_by_hr = dm_df.groupby(dm_df['surveyTime'].dt.hour).size(
-).reset_index().rename(columns={0: 'Inputs (n)', 'surveyTime': 'Hour'})
-dm_hr_svy = dm_df.groupby(dm_df['surveyTime'].dt.hour)[emotions_svy].mean(
-).reset_index().rename(columns={'surveyTime': 'Hour'})
-dm_hr_svy_sc = dm_df.groupby(dm_df['surveyTime'].dt.hour)[
-    emotions_svy_sc].mean().reset_index().rename(columns={'surveyTime': 'Hour'})
+    # Read in the daily moods data
+    return prepare_daily_moods(read_csv(mood_csv))
 
-hours = text_by_hr['Hour'].reset_index()
-dfs = [hours, dm_by_hr, dm_hr_svy, dm_hr_svy_sc]
-dm_hourly = reduce(lambda left, right: pd.merge(
-    left, right, on=['Hour'], how='left'), dfs)
 
-del df
+def survey_hourly(source):
+
+    # Number of survey inputs and mean emotions per hour, lined up with the
+    # hours of the text inputs
+    hours = load_text_hours().reset_index()
+    by_hr = cube_slice(temporal_cubes[source](), source, values=emotions_svy + emotions_svy_sc)
+    return pd.merge(hours, by_hr, on=['Hour'], how='left')
+
+
+def load_dm_hourly():
+    return survey_hourly('Daily Moods')
 
 
 # ---- DEQ DATA PREPARATION ---- #
 
-# Read in the keyboard input data
-df = pd.read_csv("Pilot DEQ Data.csv")
-
-# Get the date and time
-df['surveyTime'] = pd.to_datetime(df['surveyTime'], format='%Y-%m-%d-%H-%M-%S')
-
-# Fix up lonely as the "5" has been recorded as "Quite a bit" - needs to be numeric;
-df['Lonely-S'] = df['Lonely-S'].replace("Quite a bit", "5").astype('int64')
-
-# Calcuate the DEQ scores for each emotion
-df['Anger_Survey'] = df[['Anger-Ag', 'Rage-Ag',
-                         'Pissed-Off-Ag', 'Mad-Ag']].sum(axis=1)
-df['Sadness_Survey'] = df[['Sad-S', 'Grief-S',
-                           'Lonely-S', 'Empty-S']].sum(axis=1)
-df['Fear_Survey'] = df[['Terror-F', 'Panic-F',
-                        'Scared-F', 'Fear-F']].sum(axis=1)
-df['Joy_Survey'] = df[['Happy-H', 'Satisfaction-H',
-                       'Enjoyment-H', 'Linking-H']].sum(axis=1)
-df['Disgust_Survey'] = df[['Grossed-Out-Dg', 'Sickened-Dg',
-                           'Nausea-Dg', 'Revulsion-Dg']].sum(axis=1)
-
-# Normalise the emotions using Min Max scaling (values will be from 0 - 1)
-df[emotions_svy_sc] = scaler.fit_transform(df[emotions_svy])
-
-# Normalise the emotions using percentile rank
-df[emotions_svy_rk] = df[emotions_svy].rank(pct=True)
-# Put into 3 groups (Low, Medium, High)
-for i in emotions_svy_rk:
-    colname = i + '_grp'
-    df[colname] = bins3(df, i)
-
-# Create final dataframe to use in matching
-deq_df = df[user_time + emotions_svy + emotions_svy_sc +
-            emotions_svy_rk + emotions_svy_rk_grp].copy()
-
-# Get the number of DEQ inputs per hour
-deq_by_hr = deq_df.groupby(deq_df['surveyTime'].dt.hour).size(
-).reset_index().rename(columns={0: 'Inputs (n)', 'surveyTime': 'Hour'})
-deq_hr_svy = deq_df.groupby(deq_df['surveyTime'].dt.hour)[
-    emotions_svy].mean().reset_index().rename(columns={'surveyTime': 'Hour'})
-deq_hr_svy_sc = deq_df.groupby(deq_df['surveyTime'].dt.hour)[
-    emotions_svy_sc].mean().reset_index().rename(columns={'surveyTime': 'Hour'})
-
-hours = text_by_hr['Hour'].reset_index()
-dfs = [hours, deq_by_hr, deq_hr_svy, deq_hr_svy_sc]
-deq_hourly = reduce(lambda left, right: pd.merge(
-    left, right, on=['Hour'], how='left'), dfs)
-
-del df
+@instrumented()
+def prepare_deq(df):
+
+    # Get the date and time
+    df['surveyTime'] = pd.to_datetime(df['surveyTime'], format='%Y-%m-%d-%H-%M-%S')
+
+    # Calcuate the DEQ scores for each emotion (and the other DEQ subscales)
+    # from the scoring spec; "Quite a bit" recorded for Lonely is recoded to 5
+    scores = score_items(df, deq_scoring, errors=survey_errors)
+    df[emotions_svy + deq_other] = scores[emotions_svy + deq_other]
+
+    # Normalise the emotions using Min Max scaling (values will be from 0 - 1)
+    # and percentile rank, and put the ranks into 3 groups (Low, Medium, High;
+    # tertiles left empty by ties, as for Disgust, are merged)
+    normalise(df, emotions_svy, emotions_svy_sc, emotions_svy_rk)
+
+    # Final dataframe to use in matching
+    return compact(df[user_time + user_info + emotions_svy + emotions_svy_sc +
+                      emotions_svy_rk + emotions_svy_rk_grp + deq_other])
+
+
+@snapshotted('deq_df', deq_csv)
+def load_deq():
+
+    # Read in the DEQ data
+    return prepare_deq(read_csv(deq_csv))
+
+
+def load_deq_hourly():
+    return survey_hourly('DEQ')
+
+
+# ---- TEMPORAL AGGREGATE CUBES (ONE PER SOURCE) ---- #
+
+# Built once from each prepared frame and keyed by its own CSV; any temporal
+# view (by hour, weekday, study day and / or user group) is then a slice of
+# it, not another scan
+
+@snapshotted('text_cube', keyboard_csv)
+def load_text_cube():
+    return temporal_cube(load_text(), 'Text', 'inputTime', emotions_txt + emotions_txt_sc)
+
+
+@snapshotted('dm_cube', mood_csv)
+def load_dm_cube():
+    return temporal_cube(load_daily_moods(), 'Daily Moods', 'surveyTime', emotions_svy + emotions_svy_sc)
+
+
+@snapshotted('deq_cube', deq_csv)
+def load_deq_cube():
+    return temporal_cube(load_deq(), 'DEQ', 'surveyTime', emotions_svy + emotions_svy_sc)
+
+
+temporal_cubes = {'Text': load_text_cube, 'Daily Moods': load_dm_cube, 'DEQ': load_deq_cube}
+
+
+# ---- LINKAGE INDEX (ONE PER TEXT/SURVEY PAIR, BUILT ON FIRST USE) ---- #
+
+text_sources = {'Raw': load_text, 'Rolled up': load_rollup}
+survey_sources = {'Daily Moods': load_daily_moods, 'DEQ': load_deq}
+
+
+def get_linkage_index(main_file, linkage_file):
+    # Kept per data version, so a new export builds a new index
+    return _linkage_index(main_file, linkage_file, data_version())
+
+
+@functools.lru_cache(maxsize=len(text_sources) * len(survey_sources))
+def _linkage_index(main_file, linkage_file, version):
+    return linkage_index(text_sources[main_file](),
+                         survey_sources[linkage_file](),
+                         linkage_index_mins)
+
+
+def get_linkage(main_file, linkage_file, mins, mode='All in window'):
+    # Every survey in the window is a filter on the index; the nearest modes
+    # are an as-of join of the two prepared files
+    if mode == 'All in window':
+        return linkage_window(get_linkage_index(main_file, linkage_file), mins)
+    return linkage_nearest(text_sources[main_file](), survey_sources[linkage_file](), mins, mode)
+
+
+# Version of the data behind the linkage results (changes with the pipeline
+# version or any of the source files)
+def data_version():
+    return (pipeline_version,) + source_stamp((keyboard_csv, mood_csv, deq_csv))
+
+
+# ---- DAILY REFRESH (python getdata.py) ---- #
+
+# Brings every snapshot up to date with the source CSVs; when the keyboard
+# export only had rows appended, only those rows are prepared
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Bring the prepared data snapshots up to date')
+    parser.add_argument('--stream', action='store_true',
+                        help='prepare the rolled up text chunk by chunk (for very large keyboard '
+                             'exports); the raw text frame is then not built')
+    parser.add_argument('--chunksize', type=int, default=50000)
+    parser.add_argument('--out', help='with --stream, also write the prepared inputs to this Parquet file')
+    parser.add_argument('--strict', action='store_true',
+                        help='stop at any invalid survey answer instead of leaving it out')
+    args = parser.parse_args()
+    if args.strict:
+        survey_errors = 'raise'
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.stream:
+        for name, df in refresh_from_stream(keyboard_csv, args.chunksize, args.out).items():
+            logger.info('%s (streamed): %d rows', name, len(df))
+        frames = {'text_rollup_df': load_rollup, 'dm_df': load_daily_moods, 'deq_df': load_deq}
+    else:
+        frames = {'text_df': load_text, 'text_rollup_df': load_rollup, 'dm_df': load_daily_moods,
+                  'deq_df': load_deq}
+    for load in frames.values():
+        logger.info('%s: %d rows', load.__name__, len(load()))
+    for load in temporal_cubes.values():
+        logger.info('%s: %d rows', load.__name__, len(load()))
+    logger.info('%s', memory_report({name: load() for name, load in frames.items()}))
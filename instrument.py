@@ -0,0 +1,119 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Time, memory and rows of each   #
+#           stage of the pipeline           #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+logger = logging.getLogger('instrument')
+
+# The most recent stage records (every session, newest last)
+recent = deque(maxlen=1000)
+
+_sequence = itertools.count()
+_local = threading.local()
+
+
+# ---- PEAK MEMORY OF THE PROCESS ---- #
+
+def peak_rss_mb():
+    # High water mark of the resident memory (one cheap system call; reported
+    # in kB on Linux and in bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _rows(value):
+    # Rows of a frame (or of the first frame in a tuple / dict of results)
+    if isinstance(value, (tuple, list)):
+        value = next((v for v in value if hasattr(v, 'shape')), None)
+    elif isinstance(value, dict):
+        value = next((v for v in value.values() if hasattr(v, 'shape')), None)
+    shape = getattr(value, 'shape', None)
+    return int(shape[0]) if shape else None
+
+
+# ---- STAGE: CONTEXT MANAGER AND DECORATOR ---- #
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+
+    # Records the wall time, the peak memory (and how much the stage raised it)
+    # and the rows in / out; set record['rows_out'] inside the block
+    depth = getattr(_local, 'depth', 0)
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None, 'depth': depth,
+              'seq': next(_sequence)}
+    peak_before = peak_rss_mb()
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _local.depth = depth
+        peak_after = peak_rss_mb()
+        record.update(seconds=round(seconds, 4),
+                      peak_mb=None if peak_after is None else round(peak_after, 1),
+                      peak_added_mb=None if peak_after is None else round(peak_after - peak_before, 1),
+                      thread=threading.get_ident())
+        recent.append(record)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({k: v for k, v in record.items() if k not in ('thread', 'seq')}))
+
+
+def instrumented(name=None):
+
+    # Decorator form: rows in are taken from the first argument, rows out from
+    # the result
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(label, _rows(args[0]) if args else None) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = _rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+# ---- REPORT ---- #
+
+def mark():
+    # Sequence number to report the stages run from here on
+    return next(_sequence)
+
+
+def stage_report(since=0, this_thread=True):
+    import pandas as pd
+    thread = threading.get_ident()
+    rows = [r for r in list(recent)
+            if r['seq'] > since and (not this_thread or r['thread'] == thread)]
+    report = pd.DataFrame(rows, columns=['stage', 'depth', 'seconds', 'rows_in', 'rows_out',
+                                         'peak_mb', 'peak_added_mb', 'seq']).sort_values('seq')
+    # Indent nested stages, and list them in the order they started
+    report['stage'] = ['- ' * d + s for d, s in zip(report['depth'], report['stage'])]
+    report = report.astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
+    return report.drop(columns=['depth', 'seq']).reset_index(drop=True)
@@ -0,0 +1,165 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Min-max scaling, percentile     #
+#           rank and tertiles of the scores #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import numpy as np
+import pandas as pd
+
+
+# Tertile labels; a tertile left empty by ties (two equal cutpoints, or the
+# upper one at the top rank) is merged into the one below it
+tertile_labels = ['1. Low', '2. Medium', '3. High']
+tertile_cuts = [0.33, 0.66]
+
+# Labels of the bins (0, low], (low, high], (high, 1] by which are empty:
+# none, Medium, High, both
+_bin_labels = np.array([['1. Low', '2. Medium', '3. High'],
+                        ['1. Low/2. Medium', '1. Low/2. Medium', '3. High'],
+                        ['1. Low', '2. Medium/3. High', '2. Medium/3. High'],
+                        ['1. Low/2. Medium/3. High'] * 3], dtype=object)
+all_tertile_labels = ['1. Low', '1. Low/2. Medium', '1. Low/2. Medium/3. High',
+                      '2. Medium', '2. Medium/3. High', '3. High']
+
+
+def _quantile(sorted_values, starts, counts, q):
+    # q quantile of each group's run of sorted values, interpolated linearly
+    # the way numpy does (so the cutpoints match Series.quantile exactly)
+    h = (counts - 1) * q
+    lo = np.floor(h).astype('int64')
+    t = h - lo
+    a = sorted_values[starts + lo]
+    b = sorted_values[starts + np.minimum(lo + 1, counts - 1)]
+    return np.where(t < 0.5, a + (b - a) * t, b - (b - a) * (1 - t))
+
+
+# ---- NORMALISER: FIT ONCE, TRANSFORM ANY ROWS ---- #
+
+class ScoreNormalizer:
+
+    # Min-max scaling, percentile rank and tertile group of each score column,
+    # over all rows or within each value of `by` (e.g. 'userId' or
+    # 'userGroup'). fit() keeps, for each column, the fitted scores sorted by
+    # (group, score), so new rows are placed among them without refitting; all
+    # the groups are handled together by one sort and binary searches.
+    #
+    #   normalizer = ScoreNormalizer(emotions_svy, emotions_svy_sc, emotions_svy_rk)
+    #   df[...] = normalizer.fit_transform(df)
+
+    def __init__(self, columns, scaled, ranked, by=None):
+        self.columns = list(columns)
+        self.scaled = list(scaled)
+        self.ranked = list(ranked)
+        self.grouped = [col + '_grp' for col in self.ranked]
+        self.by = by
+        self.fitted = None
+
+    def _group_codes(self, df):
+        # Position of each row's group among the fitted groups (-1: unseen)
+        if self.by is None:
+            return np.zeros(len(df), dtype='int64')
+        return self.groups.get_indexer(df[self.by])
+
+    def fit(self, df):
+        if self.by is None:
+            self.groups = pd.Index(['All'])
+        else:
+            self.groups = pd.Index(pd.unique(df[self.by].dropna()))
+        codes = self._group_codes(df)
+        n_groups = len(self.groups)
+
+        self.fitted = {}
+        for col in self.columns:
+            values = df[col].to_numpy(dtype='float64')
+            ok = ~np.isnan(values) & (codes >= 0)
+            g, v = codes[ok], values[ok]
+            order = np.lexsort((v, g))
+            g, v = g[order], v[order]
+
+            # Where each group starts in the sorted scores, and its size
+            starts = np.searchsorted(g, np.arange(n_groups + 1))
+            counts = np.diff(starts)
+            present = counts > 0
+            lowest = np.full(n_groups, np.nan)
+            highest = np.full(n_groups, np.nan)
+            lowest[present] = v[starts[:-1][present]]
+            highest[present] = v[starts[1:][present] - 1]
+
+            # Tertile cutpoints of the fitted percentile ranks; the ranks in
+            # sorted order are the mid-ranks of the runs of tied scores
+            fit = {'g': g, 'v': v, 'starts': starts, 'counts': counts,
+                   'min': lowest, 'max': highest}
+            self.fitted[col] = fit
+            cuts = np.full((n_groups, len(tertile_cuts)), np.nan)
+            if present.any():
+                ranks = self._pct_rank(col, g, v)
+                for j, q in enumerate(tertile_cuts):
+                    cuts[present, j] = _quantile(ranks, starts[:-1][present], counts[present], q)
+            fit['cuts'] = cuts
+
+            # Labels of the bins in each group, and the labels used by any group
+            empty = (cuts[:, 1] <= cuts[:, 0]).astype('int64') + 2 * (cuts[:, 1] >= 1)
+            fit['labels'] = _bin_labels[empty]
+            used = set(fit['labels'][present].ravel())
+            fit['categories'] = [label for label in all_tertile_labels if label in used]
+
+        return self
+
+    def _pct_rank(self, col, g, v):
+        # Mid-rank of each (group, score) among the fitted scores of its group,
+        # as a fraction of the group's size (the same as .rank(pct=True) on
+        # the fitted rows)
+        fit = self.fitted[col]
+        unique = np.unique(fit['v'])
+        span = 2 * len(unique) + 2
+
+        # Scores as integers that keep their order: odd for a fitted score,
+        # even for one falling between fitted scores
+        pos = np.searchsorted(unique, v)
+        exact = unique[np.minimum(pos, len(unique) - 1)] == v
+        key = g * span + 2 * pos + exact
+        fitted_key = fit['g'] * span + 2 * np.searchsorted(unique, fit['v']) + 1
+
+        below = np.searchsorted(fitted_key, key, side='left')
+        upto = np.searchsorted(fitted_key, key, side='right')
+        start = fit['starts'][g]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return ((below - start) + (upto - start) + 1) / 2 / fit['counts'][g]
+
+    def transform(self, df):
+        if self.fitted is None:
+            raise ValueError('ScoreNormalizer is not fitted')
+        codes = self._group_codes(df)
+        out = {}
+        for col, scaled, ranked, grouped in zip(self.columns, self.scaled, self.ranked, self.grouped):
+            fit = self.fitted[col]
+            values = df[col].to_numpy(dtype='float64')
+            g = np.maximum(codes, 0)
+            ok = ~np.isnan(values) & (codes >= 0) & (fit['counts'][g] > 0)
+
+            # Min-max scaling (a column with one value scales to 0)
+            span = fit['max'][g] - fit['min'][g]
+            with np.errstate(invalid='ignore'):
+                sc = (values - fit['min'][g]) / np.where(span == 0, 1, span)
+            out[scaled] = np.where(ok, sc, np.nan)
+
+            # Percentile rank and tertile group
+            pct = np.full(len(df), np.nan)
+            pct[ok] = self._pct_rank(col, g[ok], values[ok])
+            out[ranked] = pct
+            cuts = fit['cuts'][g]
+            with np.errstate(invalid='ignore'):
+                bin_ = (pct > cuts[:, 0]).astype('int64') + (pct > cuts[:, 1])
+            labels = fit['labels'][g, bin_]
+            out[grouped] = pd.Categorical(np.where(ok, labels, None),
+                                          categories=fit['categories'], ordered=True)
+
+        return pd.DataFrame(out, index=df.index)[self.scaled + self.ranked + self.grouped]
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
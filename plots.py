@@ -15,7 +15,22 @@
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objs as go
+from plotly.subplots import make_subplots
 import numpy as np
+import pandas as pd
+
+from instrument import instrumented, stage
+
+# Above this many points the scatter plots switch to a large data mode: binned
+# counts (or a WebGL sample of the points) with closed form regression lines
+scatter_max_points = 20000
+
+
+# -- Draw a figure (the time includes serialising it for the browser) -- #
+
+def show_figure(fig):
+    with stage('plotly_chart'):
+        st.plotly_chart(fig)
 
 
 # -- Hourly charts -- #
@@ -24,19 +39,87 @@ def n_hourly_plots(data, x, y, title):
     fig = px.line(data, x=x, y=y, title=title)
     fig.update_xaxes(nticks=24)
     fig.update_layout(width=1500, height=300)
-    st.plotly_chart(fig)
+    show_figure(fig)
 
 
 def mean_hourly_plots(data, x, y, title):
     fig = px.line(data, x=x, y=y, title=title)
     fig.update_xaxes(nticks=24)
     fig.update_layout(width=1600, height=400)
-    st.plotly_chart(fig)
+    show_figure(fig)
+
+# -- Least squares lines for every facet (and colour) at once -- #
+
+
+def ols_lines(data, x, y, by):
+    ok = data[x].notna() & data[y].notna()
+    d = pd.DataFrame({k: data.loc[ok, k] for k in by})
+    d['x'] = data.loc[ok, x].astype('float64')
+    d['y'] = data.loc[ok, y].astype('float64')
+    d['xx'] = d['x'] * d['x']
+    d['xy'] = d['x'] * d['y']
+    grouped = d.groupby(by, sort=False, observed=True)
+    s = grouped[['x', 'y', 'xx', 'xy']].sum()
+    n = grouped.size()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * s['xy'] - s['x'] * s['y']) / (n * s['xx'] - s['x'] ** 2)
+    intercept = (s['y'] - slope * s['x']) / n
+    x0, x1 = grouped['x'].min(), grouped['x'].max()
+    return pd.DataFrame({'n': n, 'slope': slope, 'intercept': intercept,
+                         'x0': x0, 'x1': x1,
+                         'y0': intercept + slope * x0,
+                         'y1': intercept + slope * x1}).reset_index()
+
+
+def add_ols_lines(fig, lines, facets, colors=None, color=None):
+    for row in lines.itertuples(index=False):
+        line_color = colors[getattr(row, color)] if color else 'black'
+        fig.add_trace(go.Scatter(x=[row.x0, row.x1], y=[row.y0, row.y1], mode='lines',
+                                 line=dict(color=line_color), showlegend=False,
+                                 hovertext=f'y = {row.intercept:.4g} + {row.slope:.4g}x (n = {row.n})'),
+                      row=1, col=facets.index(row.Emotion) + 1)
+
+
+def binned_scatter(data, x, y, facets, bins=40):
+
+    # Counts of the points in a grid of bins, for every facet in one histogram
+    # (only the counts go to the browser, not the points)
+    ok = data[x].notna() & data[y].notna()
+    xs, ys = data.loc[ok, x].astype('float64'), data.loc[ok, y].astype('float64')
+    codes = pd.Categorical(data.loc[ok, 'Emotion'], categories=facets).codes
+    x_edges = np.histogram_bin_edges(xs, bins)
+    y_edges = np.histogram_bin_edges(ys, bins)
+    counts = np.histogramdd(np.column_stack([codes, xs, ys]),
+                            bins=[np.arange(len(facets) + 1) - 0.5, x_edges, y_edges])[0]
+
+    fig = make_subplots(rows=1, cols=len(facets), subplot_titles=facets, shared_yaxes=True)
+    for i in range(len(facets)):
+        fig.add_trace(go.Heatmap(z=np.where(counts[i].T > 0, counts[i].T, np.nan),
+                                 x=(x_edges[:-1] + x_edges[1:]) / 2,
+                                 y=(y_edges[:-1] + y_edges[1:]) / 2,
+                                 coloraxis='coloraxis', name='Points (n)'),
+                      row=1, col=i + 1)
+    fig.update_layout(coloraxis=dict(colorscale='Blues'))
+    fig.update_xaxes(title_text=x)
+    fig.update_yaxes(title_text=y, col=1)
+    return fig
+
 
 # -- Scatter plot with regression line BY user group -- #
 
+# The make_* functions build the figures (so they can be cached), the
+# capitalised functions draw them
 
-def ScatterReg(data):
+
+@instrumented()
+def make_scatter_reg(data):
+    if len(data) > scatter_max_points:
+        facets = list(pd.unique(data['Emotion']))
+        fig = binned_scatter(data, 'Survey', 'Algorithm', facets)
+        add_ols_lines(fig, ols_lines(data, 'Survey', 'Algorithm', ['Emotion']), facets)
+        fig.update_layout(title='Binned scatter plot of Survey vs. Algorithm')
+        fig.update_layout(width=1600, height=400)
+        return fig
     fig = px.scatter(data,
                      x="Survey",
                      y="Algorithm",
@@ -46,21 +129,62 @@ def ScatterReg(data):
     fig.update_layout(width=1600, height=400)
     for a in fig.layout.annotations:
         a.text = a.text.split("=")[1]
-    st.plotly_chart(fig)
+    return fig
 
 
-def ScatterRegUser(data):
-    fig = px.scatter(data,
-                     x="Survey",
-                     y="Algorithm",
-                     facet_col="Emotion",
-                     color='userGroup',
-                     trendline="ols")
-    fig.update_layout(title='Scatter plot of Survey vs. Algorithm')
+@instrumented()
+def make_scatter_reg_user(data):
+    if len(data) > scatter_max_points:
+        # A WebGL sample of the points, with the lines fitted on all of them
+        facets = list(pd.unique(data['Emotion']))
+        groups = sorted(data['userGroup'].dropna().unique())
+        colors = dict(zip(groups, px.colors.qualitative.Plotly))
+        fig = px.scatter(data.sample(scatter_max_points, random_state=0),
+                         x="Survey",
+                         y="Algorithm",
+                         facet_col="Emotion",
+                         color='userGroup',
+                         category_orders={'Emotion': facets, 'userGroup': groups},
+                         color_discrete_map=colors,
+                         opacity=0.4,
+                         render_mode='webgl')
+        add_ols_lines(fig, ols_lines(data, 'Survey', 'Algorithm', ['Emotion', 'userGroup']),
+                      facets, colors, 'userGroup')
+        fig.update_layout(title=f'Scatter plot of Survey vs. Algorithm '
+                                f'(sample of {scatter_max_points} of {len(data)} points)')
+    else:
+        fig = px.scatter(data,
+                         x="Survey",
+                         y="Algorithm",
+                         facet_col="Emotion",
+                         color='userGroup',
+                         trendline="ols")
+        fig.update_layout(title='Scatter plot of Survey vs. Algorithm')
     fig.update_layout(width=1600, height=400)
     for a in fig.layout.annotations:
         a.text = a.text.split("=")[1]
-    st.plotly_chart(fig)
+    return fig
+
+
+# -- Correlation by linkage window, one panel per user group -- #
+
+@instrumented()
+def make_window_curve(curve, group_col='userGroup'):
+    fig = px.line(curve, x='Window', y='Correlation', color='Algorithm',
+                  facet_col=group_col, hover_data=['Survey', 'n'])
+    fig.update_layout(title='Correlation of Algorithm vs. Survey by linkage window (mins)')
+    fig.update_layout(width=1600, height=400)
+    for a in fig.layout.annotations:
+        a.text = a.text.split("=")[1]
+    return fig
+
+
+def ScatterReg(data):
+    show_figure(make_scatter_reg(data))
+
+
+def ScatterRegUser(data):
+    show_figure(make_scatter_reg_user(data))
 
 # -- Correlation plot of the emotions -- #
 
@@ -87,7 +211,7 @@ def CorrHeatmap(data, emotionslist):
                      ticktext=ticklabels)
     fig.update_layout(title="Correlation Heatmap",
                       yaxis_autorange='reversed', template='plotly_white')
-    st.plotly_chart(fig)
+    show_figure(fig)
 
 # -- Stacked bar chart comparing the tertile membership of Algorithm vs. Survey  -- #
 
@@ -96,4 +220,67 @@ def stacked_bar(data, title):
     fig = px.bar(data, x="Algorithm", y='%', color="Survey",
                  title=title,
                  barmode='relative')
-    st.plotly_chart(fig)
+    show_figure(fig)
+
+
+# -- Paginated table: sorted / filtered here, only the page is sent -- #
+
+
+def _rank(col):
+    # Position of every value in sorted order (categories are kept sorted)
+    if hasattr(col, 'cat') and not col.cat.ordered:
+        col = col.astype('object')
+    return pd.factorize(col, sort=True)[0]
+
+
+def _contains(col, text):
+    # Substring match, done once per distinct value for categoricals
+    if hasattr(col, 'cat'):
+        hit = np.asarray(col.cat.categories.astype(str).str.contains(text, case=False, regex=False))
+        codes = col.cat.codes.to_numpy()
+        return np.where(codes >= 0, hit[codes], False)
+    return col.astype(str).str.contains(text, case=False, regex=False).to_numpy()
+
+
+def paged_table(df, key, time_col, page_size=20):
+
+    cols = st.beta_columns(5)
+    with cols[0]:
+        user = st.text_input('userId contains', key=key + '_user')
+    with cols[1]:
+        groups = st.multiselect('userGroup', sorted(df['userGroup'].dropna().unique()),
+                                key=key + '_group')
+    with cols[2]:
+        times = df[time_col].dropna()
+        dates = st.date_input(f'{time_col} from / to',
+                              (times.min().date(), times.max().date()) if len(times) else None,
+                              key=key + '_dates')
+    with cols[3]:
+        sort_col = st.selectbox('Sort by', ['(none)', 'userId', 'userGroup', time_col],
+                                key=key + '_sort')
+    with cols[4]:
+        descending = st.checkbox('Descending', key=key + '_desc')
+
+    # Filter and sort the row positions only, the frame itself is not copied
+    keep = np.ones(len(df), dtype=bool)
+    if user:
+        keep &= _contains(df['userId'], user)
+    if groups:
+        keep &= df['userGroup'].isin(groups).to_numpy()
+    if isinstance(dates, (list, tuple)) and len(dates) == 2:
+        start, end = pd.Timestamp(dates[0]), pd.Timestamp(dates[1]) + pd.Timedelta(days=1)
+        keep &= ((df[time_col] >= start) & (df[time_col] < end)).to_numpy()
+    rows = np.flatnonzero(keep)
+    if sort_col != '(none)':
+        # Missing values (rank -1) go last either way, as in sort_values
+        rank = _rank(df[sort_col])[rows]
+        rows = rows[np.lexsort((-rank if descending else rank, rank < 0))]
+
+    n_pages = max(1, -(-len(rows) // page_size))
+    page = st.number_input(f'Page (of {n_pages})', min_value=1, max_value=n_pages,
+                           value=1, step=1, key=key + '_page')
+    first = (int(page) - 1) * page_size
+    st.write(f'Rows {min(first + 1, len(rows))} to {min(first + page_size, len(rows))} '
+             f'of {len(rows)}')
+    # Only the rows on this page are formatted for display
+    st.write(df.iloc[rows[first:first + page_size]].astype('object'))
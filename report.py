@@ -0,0 +1,119 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Batch report of every linkage   #
+#           selection (no dashboard)        #
+# ----------------------------------------- #
+
+# Usage: python report.py [--out report] [--workers N]
+
+
+# ---- IMPORTS ---- #
+
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from functions import *
+from getdata import text_sources, survey_sources, get_linkage_index, data_version
+
+
+logger = logging.getLogger(__name__)
+
+# The threshold sweeps of sections 7 to 10 (filter column, thresholds)
+sweeps = {'Subjectivity': ('subjectivity', subjectivity_thresholds),
+          'Polarity': ('polarity', polarity_thresholds),
+          'Word Count': ('word_count', word_thresholds)}
+
+
+# ---- ONE SELECTION (TEXT SOURCE, SURVEY SOURCE, WINDOW) ---- #
+
+def combinations():
+    return [(main_file, linkage_file, window)
+            for main_file in text_sources
+            for linkage_file in survey_sources
+            for window in linkage_windows]
+
+
+def analyse(main_file, linkage_file, window):
+
+    matched = linkage_window(get_linkage_index(main_file, linkage_file), window)
+
+    counts = matched['userGroup'].value_counts().reindex(user_groups, fill_value=0)
+    tables = {
+        'spearman_raw': spearman_corr(matched, corr_raw_list).rename_axis('Variable').reset_index(),
+        'spearman_scaled': spearman_corr(matched, corr_scaled_list).rename_axis('Variable').reset_index(),
+        'crosstabs': consistency_cube(matched, emotions_txt_rk_grp, emotions_svy_rk_grp,
+                                      names=emotions_txt, groups=user_groups),
+    }
+
+    # Sweeps in long format: one row per group x sweep x threshold x pair
+    pieces = []
+    for group in ['All'] + user_groups:
+        df = matched if group == 'All' else matched[matched['userGroup'] == group]
+        for name, (col, thresholds) in sweeps.items():
+            sweep = corr_sweep(df, col, thresholds, emotions_txt, emotions_svy)
+            sweep.insert(0, 'Sweep', name)
+            sweep.insert(0, 'userGroup', group)
+            pieces.append(sweep.astype({'Threshold': 'float64'}))
+    tables['sweeps'] = pd.concat(pieces, ignore_index=True)
+
+    summary = {'Text': main_file, 'Survey': linkage_file, 'Window': window,
+               'Matched': len(matched), **{f'Matched ({g})': int(n) for g, n in counts.items()}}
+    return summary, tables
+
+
+def run_one(args):
+
+    # Runs in a worker: analyse one selection and write its tables
+    main_file, linkage_file, window, out_dir = args
+    start = time.perf_counter()
+    summary, tables = analyse(main_file, linkage_file, window)
+    name = f"{main_file}_{linkage_file}_{window}".replace(' ', '_').lower()
+    for table, df in tables.items():
+        path = os.path.join(out_dir, table, name + '.parquet')
+        df.to_parquet(path, index=False)
+    summary['Seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+# ---- ALL SELECTIONS ACROSS A PROCESS POOL ---- #
+
+def run_report(out_dir='report', workers=None):
+
+    for table in ('spearman_raw', 'spearman_scaled', 'crosstabs', 'sweeps'):
+        os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+
+    # Prepare the data and the linkage indexes once here; with fork the workers
+    # inherit them rather than each preparing them again
+    for main_file in text_sources:
+        for linkage_file in survey_sources:
+            get_linkage_index(main_file, linkage_file)
+
+    jobs = [combo + (out_dir,) for combo in combinations()]
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        summary = pd.DataFrame(list(pool.map(run_one, jobs)))
+
+    summary['Data version'] = hashlib.sha1(repr(data_version()).encode()).hexdigest()[:12]
+    summary.to_csv(os.path.join(out_dir, 'summary.csv'), index=False)
+    logger.info('Wrote %d selections to %s', len(summary), out_dir)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the linkage results for every selection')
+    parser.add_argument('--out', default='report', help='output folder')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    print(run_report(args.out, args.workers).to_string(index=False))
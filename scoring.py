@@ -0,0 +1,143 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Score the survey items into     #
+#           subscales from a scoring spec   #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+# ---- SCORING SPECS ---- #
+
+# Each instrument is described by a spec rather than by code:
+#   items    item column -> subscale it adds to
+#   reverse  reverse-keyed items (scored as low + high - answer)
+#   range    lowest and highest valid answer
+#   recode   text labels the app recorded in place of a number
+# An unanswered item adds nothing to its subscale; a subscale with no answered
+# items is missing.
+
+# Discrete Emotions Questionnaire: 4 items per emotion, 1 (not at all) to 7
+# (an extreme amount). The item names end with the emotion's code.
+deq_codes = {'Ag': 'Anger_Survey', 'S': 'Sadness_Survey', 'F': 'Fear_Survey',
+             'H': 'Joy_Survey', 'Dg': 'Disgust_Survey', 'Ax': 'Anxiety_Survey',
+             'Dr': 'Desire_Survey', 'R': 'Relaxation_Survey'}
+deq_items = ['Anger-Ag', 'Rage-Ag', 'Pissed-Off-Ag', 'Mad-Ag',
+             'Sad-S', 'Grief-S', 'Lonely-S', 'Empty-S',
+             'Terror-F', 'Panic-F', 'Scared-F', 'Fear-F',
+             'Happy-H', 'Satisfaction-H', 'Enjoyment-H', 'Linking-H',
+             'Grossed-Out-Dg', 'Sickened-Dg', 'Nausea-Dg', 'Revulsion-Dg',
+             'Dread-Ax', 'Anxiety-Ax', 'Nervous-Ax', 'Worry-Ax',
+             'Wanting-Dr', 'Desire-Dr', 'Craving-Dr', 'Longing-Dr',
+             'Easygoing-R', 'Chilled-Out-R', 'Calm-R', 'Relaxation-R']
+
+deq_scoring = {'name': 'DEQ',
+               'items': {item: deq_codes[item.rsplit('-', 1)[1]] for item in deq_items},
+               'reverse': [],
+               'range': (1, 7),
+               # The pilot app recorded a 5 for Lonely as its label
+               'recode': {'Quite a bit': 5}}
+
+# Daily Moods: one 1 to 10 rating per emotion, already its own score
+daily_moods_scoring = {'name': 'Daily Moods',
+                       'items': {col: col for col in ['Anger_Survey', 'Sadness_Survey', 'Fear_Survey',
+                                                      'Joy_Survey', 'Disgust_Survey']},
+                       'reverse': [],
+                       'range': (1, 10),
+                       'recode': {}}
+
+
+# ---- ITEMS AS ONE NUMERIC MATRIX ---- #
+
+def item_matrix(df, spec):
+
+    # The answers to every item of the spec as one float matrix (rows x items),
+    # and a report of every answer that is not valid (all of them, not just
+    # the first). Text columns are recoded and parsed together in one pass.
+    items = list(spec['items'])
+    low, high = spec['range']
+    present = [item for item in items if item in df.columns]
+    problems = [pd.DataFrame({'row': None, 'value': None, 'problem': 'column missing',
+                              'item': [item for item in items if item not in present]})]
+
+    X = np.full((len(df), len(items)), np.nan)
+    cols = {item: j for j, item in enumerate(items)}
+    numeric = [item for item in present if df[item].dtype.kind in 'biuf']
+    text = [item for item in present if item not in numeric]
+    if numeric:
+        X[:, [cols[item] for item in numeric]] = df[numeric].to_numpy(dtype='float64')
+    if text:
+        raw = df[text].to_numpy(dtype=object)
+        cells = pd.Series(raw.ravel())
+        parsed = pd.to_numeric(cells.replace(spec['recode']), errors='coerce').to_numpy(dtype='float64')
+        parsed = parsed.reshape(raw.shape)
+        X[:, [cols[item] for item in text]] = parsed
+
+        # Answers that were there but could not be read
+        unread = np.isnan(parsed) & pd.notna(raw)
+        rows, at = np.nonzero(unread)
+        problems.append(pd.DataFrame({'row': df.index[rows], 'item': np.array(text)[at],
+                                      'value': raw[rows, at], 'problem': 'not a number'}))
+
+    # Answers outside the valid range
+    with np.errstate(invalid='ignore'):
+        outside = (X < low) | (X > high)
+    rows, at = np.nonzero(outside)
+    problems.append(pd.DataFrame({'row': df.index[rows], 'item': np.array(items, dtype=object)[at],
+                                  'value': X[rows, at], 'problem': f'outside {low} to {high}'}))
+    X[outside] = np.nan
+
+    report = pd.concat(problems, ignore_index=True)[['row', 'item', 'value', 'problem']]
+    return X, report
+
+
+def invalid_report(report, name):
+    # One message for all the invalid answers: how many of each problem by item
+    counts = report.groupby(['item', 'problem'], sort=False).size()
+    lines = [f'{item}: {n} {problem}' for (item, problem), n in counts.items()]
+    return f'{len(report)} invalid {name} answers\n' + '\n'.join(lines)
+
+
+# ---- SUBSCALE SCORES FROM ONE MATRIX PRODUCT ---- #
+
+def score_items(df, spec, errors='raise'):
+
+    # Subscale scores of every row. With errors='raise' any invalid answer
+    # stops the scoring (after reporting all of them); with 'coerce' they are
+    # left out as if unanswered, and reported once as a warning. The scores and the number of answered items
+    # of every subscale come from one product of [answers | answered] with the
+    # scoring weights (+1 per item, -1 and low + high for a reversed one).
+    X, report = item_matrix(df, spec)
+    if len(report):
+        if errors == 'raise':
+            raise ValueError(invalid_report(report, spec['name']))
+        logger.warning('Left out as unanswered: %s', invalid_report(report, spec['name']))
+
+    items = list(spec['items'])
+    subscales = list(dict.fromkeys(spec['items'].values()))
+    low, high = spec['range']
+    reverse = np.isin(items, list(spec['reverse']))
+    member = np.zeros((len(items), len(subscales)))
+    member[np.arange(len(items)), [subscales.index(spec['items'][item]) for item in items]] = 1
+
+    n_items, n_subscales = len(items), len(subscales)
+    weights = np.zeros((2 * n_items, 2 * n_subscales))
+    weights[:n_items, :n_subscales] = member * np.where(reverse, -1, 1)[:, None]
+    weights[n_items:, :n_subscales] = member * np.where(reverse, low + high, 0)[:, None]
+    weights[n_items:, n_subscales:] = member
+
+    answered = ~np.isnan(X)
+    totals = np.hstack([np.where(answered, X, 0), answered]) @ weights
+    scores, counts = totals[:, :n_subscales], totals[:, n_subscales:]
+    scores[counts == 0] = np.nan
+
+    return pd.DataFrame(scores, columns=subscales, index=df.index)
@@ -0,0 +1,118 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Persistent sentiment cache      #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import hashlib
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+from functions import score_sentiment
+
+
+logger = logging.getLogger(__name__)
+
+# SQLite file holding one row per distinct text ever scored
+cache_path = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '.sentiment_cache.sqlite')
+
+
+# ---- CACHE KEY: HASH OF THE NORMALISED TEXT AND THE SENTIMENT BACKEND ---- #
+
+def sentiment_backend():
+    try:
+        from importlib.metadata import version
+        return 'textblob-' + version('textblob')
+    except Exception:
+        import textblob
+        return 'textblob-' + getattr(textblob, '__version__', 'unknown')
+
+
+def normalise_text(text):
+    # Runs of whitespace do not change the TextBlob scores
+    return ' '.join(text.split())
+
+
+def text_key(text, backend):
+    return hashlib.sha1((backend + '\x00' + text).encode('utf-8')).hexdigest()
+
+
+# ---- READ / WRITE ---- #
+
+def _connect(path):
+    con = sqlite3.connect(path, timeout=30)
+    con.execute('CREATE TABLE IF NOT EXISTS sentiment '
+                '(key TEXT PRIMARY KEY, polarity REAL, subjectivity REAL) WITHOUT ROWID')
+    return con
+
+
+def _lookup(con, keys):
+    # Bulk lookup: load the wanted keys into a temporary table and join once
+    con.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (key TEXT PRIMARY KEY)')
+    con.execute('DELETE FROM wanted')
+    con.executemany('INSERT OR IGNORE INTO wanted VALUES (?)',
+                    ((key,) for key in keys))
+    rows = con.execute('SELECT s.key, s.polarity, s.subjectivity FROM sentiment s '
+                       'JOIN wanted w ON s.key = w.key').fetchall()
+    return {key: (polarity, subjectivity) for key, polarity, subjectivity in rows}
+
+
+def _store(con, scores):
+    with con:
+        con.executemany('INSERT OR REPLACE INTO sentiment VALUES (?, ?, ?)',
+                        ((key, p, s) for key, (p, s) in scores.items()))
+
+
+# ---- SCORE ONLY THE DISTINCT TEXTS NOT SEEN BEFORE ---- #
+
+def cached_sentiment(texts, workers=None, path=None):
+
+    backend = sentiment_backend()
+
+    # Deduplicate: each distinct normalised text is looked up / scored once
+    normalised = texts.map(normalise_text)
+    distinct = pd.unique(normalised.values)
+    keys = [text_key(text, backend) for text in distinct]
+
+    try:
+        con = _connect(path or cache_path)
+        found = _lookup(con, keys)
+    except sqlite3.Error as e:
+        logger.warning('Sentiment cache unavailable (%s), scoring every text', e)
+        con, found = None, {}
+
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    if missing:
+        scored = score_sentiment(distinct[missing], workers=workers)
+        new = dict(zip((keys[i] for i in missing),
+                       scored.itertuples(index=False, name=None)))
+        found.update(new)
+        if con is not None:
+            try:
+                _store(con, new)
+            except sqlite3.Error as e:
+                logger.warning('Could not update the sentiment cache (%s)', e)
+
+    if con is not None:
+        con.close()
+
+    stats = {'texts': len(texts), 'distinct': len(distinct),
+             'hits': len(distinct) - len(missing), 'misses': len(missing)}
+    logger.info('Sentiment cache: %(texts)d texts, %(distinct)d distinct, '
+                '%(hits)d hits, %(misses)d misses', stats)
+
+    # Map the distinct scores back onto every row
+    scores = pd.DataFrame([found[key] for key in keys],
+                          columns=['polarity', 'subjectivity'], dtype='float64')
+    codes = pd.Index(distinct).get_indexer(normalised.values)
+    result = scores.take(codes)
+    result.index = texts.index
+    result.attrs['sentiment_cache'] = stats
+    return result
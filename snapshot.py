@@ -0,0 +1,128 @@
+
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: On-disk snapshot of the         #
+#           prepared data frames            #
+# ----------------------------------------- #
+
+
+# ---- IMPORTS ---- #
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+# ---- WHERE THE SNAPSHOT IS KEPT ---- #
+
+# One Parquet file per frame plus a small JSON file holding the key it was built with
+snapshot_dir = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '.snapshot')
+
+
+# ---- KEY: CONTENT HASH OF THE SOURCE FILES AND THE PIPELINE VERSION ---- #
+
+def snapshot_key(paths, version):
+    key = hashlib.sha256(f'pipeline:{version}'.encode())
+    for path in paths:
+        key.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+    return key.hexdigest()
+
+
+# ---- PREFIX OF A SOURCE FILE (FOR INCREMENTAL REFRESHES) ---- #
+
+def _hash_bytes(path, size=None):
+    key = hashlib.sha256()
+    left = size
+    with open(path, 'rb') as f:
+        while left is None or left > 0:
+            block = f.read(1 << 20 if left is None else min(1 << 20, left))
+            if not block:
+                break
+            key.update(block)
+            if left is not None:
+                left -= len(block)
+    return key.hexdigest()
+
+
+def file_prefix(path):
+    # Size and content hash of the file as it is now, to be recorded with a
+    # snapshot; None when the file does not end with a complete row (a later
+    # export could then carry on that row)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(max(size - 1, 0))
+        if size == 0 or f.read(1) != b'\n':
+            return None
+    return {'source_bytes': size, 'source_hash': _hash_bytes(path)}
+
+
+def has_prefix(path, meta):
+    # Whether the file still starts with exactly the bytes the snapshot was
+    # built from, i.e. the export only had rows appended
+    size = meta.get('source_bytes')
+    if size is None or os.path.getsize(path) < size:
+        return False
+    return _hash_bytes(path, size) == meta.get('source_hash')
+
+
+# ---- READ / WRITE ---- #
+
+def _paths(name):
+    return (os.path.join(snapshot_dir, name + '.parquet'),
+            os.path.join(snapshot_dir, name + '.json'))
+
+
+def read_meta(name):
+    meta_path = _paths(name)[1]
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_snapshot(name, key):
+    meta = read_meta(name)
+    if meta is None or meta.get('key') != key:
+        return None
+    try:
+        return pd.read_parquet(_paths(name)[0])
+    except (ImportError, OSError, ValueError):
+        # No Parquet engine installed or an unreadable file: rebuild instead
+        return None
+
+
+def read_previous(name, version):
+    # The last snapshot of a frame whatever its key, as long as it was built by
+    # the same pipeline version (used to refresh it incrementally)
+    meta = read_meta(name)
+    if meta is None or meta.get('version') != version or 'source_bytes' not in meta:
+        return None
+    try:
+        return pd.read_parquet(_paths(name)[0]), meta
+    except (ImportError, OSError, ValueError):
+        return None
+
+
+def write_snapshot(name, key, df, **meta):
+    data_path, meta_path = _paths(name)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        # Drop the old key first so a half written snapshot is never read
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        df.to_parquet(data_path + '.tmp')
+        os.replace(data_path + '.tmp', data_path)
+        with open(meta_path, 'w') as f:
+            json.dump(dict(meta, key=key), f)
+    except (ImportError, OSError, ValueError):
+        # The snapshot is only a speed up, the app still works without it
+        return False
+    return True
@@ -0,0 +1,253 @@
+# ----------------------------------------- #
+#                                           #
+#  TITLE:   FRANK APP EVALUATION DASHBOARD  #
+#  PURPOSE: Synthetic study data at larger  #
+#           scales (same CSV layouts)       #
+# ----------------------------------------- #
+
+# Usage: python synthetic.py --scale 10 [--out synthetic] [--seed 0]
+# Writes the keyboard, Daily Moods and DEQ files (same names and layouts as the
+# pilot files) for scale x the pilot's number of users into <out>/x<scale>/
+
+
+# ---- IMPORTS ---- #
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from getdata import keyboard_csv, mood_csv, deq_csv
+
+
+# ---- LAYOUT OF THE PILOT FILES ---- #
+
+pilot_users = 160
+
+keyboard_columns = ['Anger', 'Sadness', 'Fear', 'Joy', 'Disgust', 'userId', 'username',
+                    'userGroup', 'userLoginTime', 'inputTime', 'inputText']
+mood_columns = ['userId', 'username', 'userGroup', 'userLoginTime', 'surveyType', 'surveyTime',
+                'Joy_Survey', 'Disgust_Survey', 'Fear_Survey', 'Sadness_Survey', 'Anger_Survey']
+# DEQ items in file order, with the pilot's number of answers of 1 to 7
+deq_items = {
+    'Anger-Ag': [139, 91, 55, 22, 7, 0, 0],
+    'Wanting-Dr': [77, 80, 69, 38, 28, 18, 4],
+    'Dread-Ax': [155, 72, 50, 22, 11, 2, 1],
+    'Sad-S': [111, 83, 56, 36, 23, 4, 1],
+    'Easygoing-R': [20, 65, 64, 59, 49, 54, 2],
+    'Grossed-Out-Dg': [259, 43, 11, 1, 0, 0, 0],
+    'Happy-H': [6, 46, 60, 84, 56, 55, 7],
+    'Terror-F': [261, 33, 13, 6, 1, 0, 0],
+    'Rage-Ag': [238, 47, 18, 5, 5, 0, 0],
+    'Grief-S': [174, 79, 34, 12, 8, 3, 4],
+    'Nausea-Dg': [239, 54, 13, 1, 4, 1, 1],
+    'Anxiety-Ax': [56, 108, 81, 32, 27, 7, 2],
+    'Chilled-Out-R': [33, 90, 67, 40, 53, 25, 6],
+    'Desire-Dr': [100, 75, 60, 45, 20, 13, 1],
+    'Nervous-Ax': [108, 93, 60, 31, 17, 4, 1],
+    'Lonely-S': [135, 57, 55, 25, 27, 13, 2],
+    'Scared-F': [191, 82, 20, 15, 4, 1, 1],
+    'Mad-Ag': [183, 64, 46, 8, 9, 0, 4],
+    'Satisfaction-H': [31, 77, 71, 61, 50, 22, 2],
+    'Sickened-Dg': [263, 37, 8, 5, 0, 0, 0],
+    'Empty-S': [157, 69, 39, 17, 23, 4, 3],
+    'Craving-Dr': [139, 68, 56, 39, 10, 1, 1],
+    'Panic-F': [217, 59, 23, 14, 0, 1, 0],
+    'Longing-Dr': [134, 66, 47, 37, 16, 12, 1],
+    'Calm-R': [18, 89, 78, 50, 46, 30, 3],
+    'Fear-F': [201, 59, 28, 15, 8, 0, 1],
+    'Relaxation-R': [30, 103, 65, 52, 43, 14, 7],
+    'Revulsion-Dg': [278, 22, 11, 1, 0, 0, 0],
+    'Worry-Ax': [56, 89, 79, 50, 24, 15, 1],
+    'Enjoyment-H': [6, 77, 75, 65, 53, 29, 9],
+    'Pissed-Off-Ag': [149, 84, 37, 23, 16, 4, 0],
+    'Linking-H': [25, 90, 66, 65, 39, 20, 3]}
+deq_columns = ['userId', 'surveyType'] + list(deq_items) + \
+    ['username', 'userGroup', 'userLoginTime', 'surveyTime']
+# Daily Moods: the pilot's number of answers of 1 to 10
+mood_counts = {'Joy_Survey': [114, 99, 148, 132, 154, 112, 108, 104, 35, 24],
+               'Disgust_Survey': [743, 122, 74, 32, 23, 19, 8, 9, 0, 0],
+               'Fear_Survey': [597, 167, 103, 51, 29, 26, 25, 20, 8, 5],
+               'Sadness_Survey': [440, 200, 124, 72, 69, 39, 43, 20, 11, 11],
+               'Anger_Survey': [632, 147, 79, 57, 37, 31, 17, 7, 3, 1]}
+mood_slots = {'morningMoods': 9.0, 'afternoonMoods': 12.5, 'eveningMoods': 16.7}
+
+# Share of the text inputs made in each hour of the day (pilot)
+hour_weights = np.array([140, 87, 62, 23, 22, 11, 52, 173, 364, 505, 462, 466,
+                         549, 616, 580, 524, 511, 614, 659, 547, 708, 875, 546, 275], dtype='float64')
+
+words = ('i you we it the a to and of in is be for on at with this that so just now today '
+         'tomorrow tonight time coffee work home lunch dinner call later soon around '
+         'love happy great good nice fun glad thanks lovely awesome excited '
+         'sad bad awful tired angry annoyed sorry worried scared sick hate terrible '
+         'grinning face with big eyes crying tears of joy red heart thumbs up').split()
+
+time_format = '%Y-%m-%d-%H-%M-%S'
+alphabet = np.array(list('0123456789abcdefghijklmnopqrstuvwxyz'))
+
+
+# ---- HELPERS ---- #
+
+def _format_times(values):
+    # Format each distinct time once
+    distinct, codes = np.unique(values, return_inverse=True)
+    return pd.DatetimeIndex(distinct).strftime(time_format).to_numpy()[codes]
+
+
+def _scores(counts, u):
+    # Answers (1, 2, ...) with the pilot's distribution, from uniform draws u
+    cdf = np.cumsum(counts) / np.sum(counts)
+    return 1 + np.searchsorted(cdf[:-1], u, side='right')
+
+
+def _uniform(z):
+    # Uniform draws in the same order as z
+    return (np.argsort(np.argsort(z)) + 0.5) / len(z)
+
+
+def _with_missing(rng, values, rate):
+    out = pd.array(values, dtype='Int64')
+    out[rng.random(len(values)) < rate] = pd.NA
+    return out
+
+
+def make_users(rng, n_users, first_id=0):
+    ids = rng.choice(alphabet, (n_users, 11))
+    login = pd.Timestamp('2021-01-15') + pd.to_timedelta(
+        rng.integers(0, 105 * 86400, n_users), unit='s')
+    return pd.DataFrame({
+        'userId': ['1' + ''.join(chars) + alphabet[i % 36] for i, chars in enumerate(ids, first_id)],
+        'username': [f'{w}{n:05d}' for w, n in zip(rng.choice(words, n_users),
+                                                   rng.integers(0, 100000, n_users))],
+        'userGroup': rng.choice(['FrankKeyboard', 'Frank', 'Keyboard'], n_users),
+        'login': login.floor('s')})
+
+
+# ---- ONE BATCH OF USERS FOR EACH FILE ---- #
+
+def keyboard_rows(rng, users):
+
+    # Users type in sessions (several inputs within the same hour) spread over
+    # the days after they logged in; the number of inputs varies a lot by user
+    users = users[rng.random(len(users)) < 0.98]
+    per_user = np.ceil(rng.lognormal(np.log(28), 1.2, len(users)) / 3.8).astype('int64')
+    session_user = np.repeat(np.arange(len(users)), per_user)
+    n_sessions = len(session_user)
+    day = np.minimum(rng.exponential(6, n_sessions).astype('int64'), 60)
+    hour = rng.choice(24, n_sessions, p=hour_weights / hour_weights.sum())
+    start = users['login'].dt.floor('D').to_numpy()[session_user] + \
+        (day * 24 + hour).astype('timedelta64[h]')
+    size = rng.geometric(1 / 3.8, n_sessions)
+
+    row_user = np.repeat(session_user, size)
+    n = len(row_user)
+    length = np.clip(rng.lognormal(np.log(8), 0.6, n).astype('int64'), 2, 300)
+    vocab = rng.choice(words, length.sum())
+    ends = np.cumsum(length)
+    texts = [' '.join(vocab[e - k:e]) for e, k in zip(ends, length)]
+
+    df = pd.DataFrame(np.minimum(rng.exponential(0.043, (n, 5)), 1).round(9),
+                      columns=keyboard_columns[:5])
+    for col in ['userId', 'username', 'userGroup']:
+        df[col] = users[col].to_numpy()[row_user]
+    df['userLoginTime'] = _format_times(users['login'].to_numpy()[row_user])
+    df['inputTime'] = _format_times(np.repeat(start, size))
+    df['inputText'] = texts
+    return df.sort_values(['userId', 'inputTime'], kind='mergesort')[keyboard_columns]
+
+
+def mood_rows(rng, users):
+
+    # Up to three surveys a day (morning, afternoon, evening)
+    users = users[rng.random(len(users)) < 0.87]
+    per_user = np.minimum(1 + rng.poisson(6.4, len(users)), 21)
+    row_user = np.repeat(np.arange(len(users)), per_user)
+    n = len(row_user)
+    slot = rng.integers(0, 3, n)
+    day = rng.integers(0, 3 + per_user[row_user] // 2)
+    hours = np.array(list(mood_slots.values()))[slot] + rng.normal(0, 1, n)
+    times = users['login'].dt.floor('D').to_numpy()[row_user] + \
+        (day * 86400 + hours * 3600).astype('timedelta64[s]')
+
+    df = pd.DataFrame({col: users[col].to_numpy()[row_user]
+                       for col in ['userId', 'username', 'userGroup']})
+    df['userLoginTime'] = _format_times(users['login'].to_numpy()[row_user])
+    df['surveyType'] = np.array(list(mood_slots))[slot]
+    df['surveyTime'] = _format_times(times)
+    for col, counts in mood_counts.items():
+        df[col] = _with_missing(rng, _scores(counts, rng.random(n)), 0.005)
+    return df.sort_values(['userId', 'surveyTime'], kind='mergesort')[mood_columns]
+
+
+def deq_rows(rng, users):
+
+    # A few DEQ surveys per user, mostly in the evening. Items of the same
+    # emotion are correlated (through a shared normal draw per emotion), and
+    # the pilot app recorded a 5 for Lonely as 'Quite a bit'
+    users = users[rng.random(len(users)) < 0.68]
+    per_user = np.minimum(1 + rng.poisson(1.9, len(users)), 7)
+    row_user = np.repeat(np.arange(len(users)), per_user)
+    n = len(row_user)
+    hours = np.clip(rng.normal(20, 2, n), 0, 23.9)
+    times = users['login'].dt.floor('D').to_numpy()[row_user] + \
+        (rng.integers(0, 15, n) * 86400 + hours * 3600).astype('timedelta64[s]')
+
+    df = pd.DataFrame({'userId': users['userId'].to_numpy()[row_user], 'surveyType': 'deq'})
+    shared = {emotion: rng.normal(size=n) for emotion in {col.rsplit('-', 1)[1] for col in deq_items}}
+    for col, counts in deq_items.items():
+        z = 0.8 * shared[col.rsplit('-', 1)[1]] + 0.6 * rng.normal(size=n)
+        scores = _scores(counts, _uniform(z))
+        if col == 'Lonely-S':
+            df[col] = np.where(scores == 5, 'Quite a bit', scores.astype(str))
+        else:
+            df[col] = _with_missing(rng, scores, 0.004)
+    for col in ['username', 'userGroup']:
+        df[col] = users[col].to_numpy()[row_user]
+    df['userLoginTime'] = _format_times(users['login'].to_numpy()[row_user])
+    df['surveyTime'] = _format_times(times)
+    return df.sort_values(['userId', 'surveyTime'], kind='mergesort')[deq_columns]
+
+
+# ---- WRITE THE THREE FILES ---- #
+
+def generate(out_dir, scale=1, seed=0, batch_users=2000):
+
+    # Users are generated in batches so memory stays bounded at any scale
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = {'keyboard': os.path.join(out_dir, keyboard_csv),
+             'mood': os.path.join(out_dir, mood_csv),
+             'deq': os.path.join(out_dir, deq_csv)}
+    n_users = int(round(pilot_users * scale))
+
+    # Line endings as in the pilot exports
+    with open(paths['keyboard'], 'w', newline='\r\n') as kb, \
+            open(paths['mood'], 'w', newline='\r\n') as mood, \
+            open(paths['deq'], 'w', newline='\n') as deq:
+        for first in range(0, n_users, batch_users):
+            users = make_users(rng, min(batch_users, n_users - first), first)
+            header = first == 0
+
+            # The keyboard export has a blank row before every input
+            rows = keyboard_rows(rng, users).reset_index(drop=True)
+            rows.index = np.arange(1, 2 * len(rows), 2)
+            rows.reindex(np.arange(2 * len(rows))).to_csv(kb, index=False, header=header)
+
+            mood_rows(rng, users).to_csv(mood, index=False, header=header)
+            deq_rows(rng, users).to_csv(deq, index=False, header=header)
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic study data')
+    parser.add_argument('--scale', type=float, default=10,
+                        help='number of users as a multiple of the pilot (e.g. 10, 100, 1000)')
+    parser.add_argument('--out', default='synthetic', help='output folder')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    out_dir = os.path.join(args.out, f'x{args.scale:g}')
+    for name, path in generate(out_dir, args.scale, args.seed).items():
+        print(name, path, os.path.getsize(path) // 2**10, 'KB')